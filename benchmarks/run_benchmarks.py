@@ -0,0 +1,329 @@
+"""Offline benchmarks for the customer service agent, Magentic and the handoff runner.
+
+Every scenario runs against a ScriptedBackend with no latency, so the numbers measure the
+framework only: time spent outside LLM calls, tokenizer time, prompt bytes sent per call and
+history growth.
+
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --baseline results.json --max-regression 0.25
+
+Exits with status 1 when a metric exceeds its limit in benchmarks/thresholds.json or regresses
+by more than --max-regression against a baseline results file. --quick runs are noisier; only
+compare them against other --quick runs, preferably on the same machine.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "magentic"))
+sys.path.insert(0, os.path.join(ROOT, "handoff"))
+
+from llm_transport import LLMBackend, ScriptedBackend
+
+import customer_service_agent
+import magentic_orchestration
+import multi_agent_handoff
+
+THRESHOLDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "thresholds.json")
+
+# Lower is better for all of these; they are the metrics checked against a baseline.
+REGRESSION_METRICS = (
+    "overhead_ms_per_turn_mean",
+    "overhead_ms_per_turn_p95",
+    "tokenizer_ms_per_turn",
+    "prompt_bytes_per_call",
+)
+
+FILLER_WORDS = (
+    "order shipment invoice refund account payment tracking carrier warehouse delay "
+    "balance statement charge duplicate credit replacement address confirmation update status"
+).split()
+
+
+def filler(seed, words):
+    # Deterministic but varied text, so loop detection and response caches see distinct messages.
+    rng = random.Random(seed)
+    return " ".join(rng.choice(FILLER_WORDS) for _ in range(words))
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class MeasuredBackend(LLMBackend):
+    """Wraps a backend and records time spent inside it, prompt bytes and message counts."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.seconds = 0.0
+        self.calls = 0
+        self.prompt_bytes = 0
+        self.message_counts = []
+
+    def _record(self, messages, kwargs, started):
+        self.seconds += time.perf_counter() - started
+        self.calls += 1
+        payload = {"messages": messages, "tools": kwargs.get("tools")}
+        self.prompt_bytes += len(json.dumps(payload, default=lambda value: getattr(value, "__dict__", str(value))))
+        self.message_counts.append(len(messages))
+
+    async def chat(self, messages, model, timeout=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await self.backend.chat(messages, model, timeout, **kwargs)
+        finally:
+            self._record(messages, kwargs, started)
+
+    def chat_sync(self, messages, model, timeout=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self.backend.chat_sync(messages, model, timeout, **kwargs)
+        finally:
+            self._record(messages, kwargs, started)
+
+
+class TimedTokenizer:
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.seconds = 0.0
+        self.calls = 0
+
+    def encode(self, text, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self.tokenizer.encode(text, *args, **kwargs)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.calls += 1
+
+
+@contextlib.contextmanager
+def patched(module, name, value):
+    original = getattr(module, name)
+    setattr(module, name, value)
+    try:
+        yield value
+    finally:
+        setattr(module, name, original)
+
+
+def summarize_turns(turn_seconds, backend_seconds, tokenizer_seconds, backend):
+    overheads = [max(0.0, total - llm) * 1000 for total, llm in zip(turn_seconds, backend_seconds)]
+    return {
+        "turns": len(turn_seconds),
+        "llm_calls": backend.calls,
+        "wall_seconds": round(sum(turn_seconds), 4),
+        "overhead_ms_per_turn_mean": round(statistics.mean(overheads), 4),
+        "overhead_ms_per_turn_p95": round(percentile(overheads, 0.95), 4),
+        "tokenizer_ms_per_turn": round(tokenizer_seconds * 1000 / len(turn_seconds), 4),
+        "prompt_bytes_per_call": round(backend.prompt_bytes / max(backend.calls, 1), 1),
+        "messages_per_call_max": max(backend.message_counts, default=0),
+    }
+
+
+def customer_service_session(turns):
+    """One long session: every turn makes one tool call, alternating local todo tools and the billing sub-agent."""
+    cs = customer_service_agent
+
+    def respond(messages, model, kwargs):
+        last = messages[-1]
+        if "tools" not in kwargs:
+            # Sub-agent consultations and history summaries.
+            return filler(len(messages), 120)
+        if last["role"] != "user":
+            return f"Here is where things stand. {filler(len(messages), 200)}"
+        turn = sum(1 for message in messages if message["role"] == "user")
+        if turn % 2:
+            todos = [{"id": f"task{turn}", "content": filler(turn, 8), "status": "pending", "priority": "medium"}]
+            return {"content": None, "tool_calls": [{"name": "todo_add", "arguments": {"todos": todos}}]}
+        return {"content": None, "tool_calls": [{"name": "consult_billing", "arguments": {"query": f"Turn {turn}: {filler(turn, 20)}"}}]}
+
+    backend = MeasuredBackend(ScriptedBackend(respond))
+    tokenizer = TimedTokenizer(cs.TOKENIZER)
+    turn_seconds, backend_seconds, history_tokens = [], [], []
+    with tempfile.TemporaryDirectory() as spill_dir, \
+            patched(cs, "session_manager", cs.SessionManager(spill_dir=spill_dir)), \
+            patched(cs, "llm_backend", backend), \
+            patched(cs, "TOKENIZER", tokenizer):
+        for turn in range(turns):
+            llm_before = backend.seconds
+            started = time.perf_counter()
+            cs.handle_customer_query(f"Customer message {turn}: {filler(turn, 40)}", "benchmark")
+            turn_seconds.append(time.perf_counter() - started)
+            backend_seconds.append(backend.seconds - llm_before)
+            history_tokens.append(cs.session_manager.get("benchmark").main_agent_history.total_tokens)
+        session = cs.session_manager.get("benchmark")
+        session.compactor.flush()
+        result = summarize_turns(turn_seconds, backend_seconds, tokenizer.seconds, backend)
+        result.update({
+            "history_messages_final": len(session.main_agent_history),
+            "history_tokens_final": session.main_agent_history.total_tokens,
+            "history_tokens_max": max(history_tokens),
+        })
+        session.close()
+    return result
+
+
+def magentic_run(rounds, repeats):
+    """A three-agent team whose ledger declares the task done after the given number of rounds."""
+    m = magentic_orchestration
+    agents = [m.Agent(name, f"expert number {index}") for index, name in enumerate(("Analyst", "Strategist", "Writer"))]
+    contexts = []
+
+    class RecordingContext(m.MagenticContext):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            contexts.append(self)
+
+    def make_responder():
+        state = {"ledgers": 0, "replies": 0}
+
+        def respond(messages, model, kwargs):
+            if kwargs.get("response_format"):
+                state["ledgers"] += 1
+                speaker = agents[state["ledgers"] % len(agents)].name
+                ledger = {
+                    "is_request_satisfied": {"reason": "", "answer": state["ledgers"] > rounds},
+                    "is_in_loop": {"reason": "", "answer": False},
+                    "is_progress_being_made": {"reason": "", "answer": True},
+                    "next_speaker": {"reason": "", "answer": speaker},
+                    "instruction_or_question": {"reason": "", "answer": f"Step {state['ledgers']}: {filler(state['ledgers'], 15)}"},
+                }
+                return json.dumps(ledger)
+            state["replies"] += 1
+            return f"Contribution {state['replies']}: {filler(state['replies'], 150)}"
+        return respond
+
+    turn_seconds, backend_seconds = [], []
+    backend = MeasuredBackend(None)
+    with patched(m, "MagenticContext", RecordingContext), contextlib.redirect_stdout(io.StringIO()):
+        for repeat in range(repeats + 1):
+            if repeat == 1:
+                # The first run only warms up; start measuring from the second.
+                turn_seconds, backend_seconds = [], []
+                backend = MeasuredBackend(None)
+            backend.backend = ScriptedBackend(make_responder())
+            manager = m.MagenticManager(max_stall_count=3, max_round_count=rounds + 2, max_reset_count=3)
+            llm_before = backend.seconds
+            started = time.perf_counter()
+            asyncio.run(m.MagenticOrchestration(agents, manager, backend=backend).run("Plan a benchmark campaign."))
+            elapsed = time.perf_counter() - started
+            # Per-round figures, so different round counts are comparable.
+            turn_seconds.extend([elapsed / rounds] * rounds)
+            backend_seconds.extend([(backend.seconds - llm_before) / rounds] * rounds)
+    result = summarize_turns(turn_seconds, backend_seconds, 0.0, backend)
+    result["history_messages_final"] = len(contexts[-1].chat_history)
+    result["history_bytes_final"] = len(contexts[-1].history_json())
+    return result
+
+
+def handoff_chain(tool_calls, repeats):
+    """Triage hands off to the math tutor, which calls its calculator tool_calls times before answering."""
+    h = multi_agent_handoff
+
+    def respond(messages, model, kwargs):
+        system = messages[0]["content"]
+        if system == h.triage_agent.instructions:
+            return {"tool_calls": [{"name": "handoff_to_math_tutor", "arguments": {"reason": "Arithmetic question"}}]}
+        calculations = sum(1 for message in messages if isinstance(message, dict) and message.get("name") == "calculate_expression")
+        if calculations < tool_calls:
+            return {"tool_calls": [{"name": "calculate_expression", "arguments": {"expression": f"sqrt({calculations + 1} * 16)"}}]}
+        return f"The answer is 4. {filler(calculations, 60)}"
+
+    for repeat in range(repeats + 1):
+        if repeat <= 1:
+            # The first run only warms up; start measuring from the second.
+            backend = MeasuredBackend(ScriptedBackend(respond))
+            turn_seconds, backend_seconds = [], []
+        llm_before = backend.seconds
+        started = time.perf_counter()
+        asyncio.run(h.run_agent(h.triage_agent, "What is the square root of 16?", {"calculate_expression": h.calculate_expression}, backend=backend, graph=h.homework_graph))
+        turn_seconds.append(time.perf_counter() - started)
+        backend_seconds.append(backend.seconds - llm_before)
+    result = summarize_turns(turn_seconds, backend_seconds, 0.0, backend)
+    result["history_messages_final"] = backend.message_counts[-1]
+    return result
+
+
+def run_suite(quick):
+    repeats = 3 if quick else 10
+    benchmarks = {"customer_service.long_session": lambda: customer_service_session(40 if quick else 200)}
+    for rounds in (3, 10, 30):
+        benchmarks[f"magentic.rounds_{rounds}"] = lambda rounds=rounds: magentic_run(rounds, repeats)
+    for tool_calls in (0, 4, 16):
+        benchmarks[f"handoff.tools_{tool_calls}"] = lambda tool_calls=tool_calls: handoff_chain(tool_calls, repeats * 5)
+    results = {}
+    for name, benchmark in benchmarks.items():
+        print(f"Running {name}...", file=sys.stderr)
+        results[name] = benchmark()
+    return results
+
+
+def check_results(results, thresholds, baseline=None, max_regression=0.25):
+    failures = []
+    for name, limits in thresholds.items():
+        for metric, limit in limits.items():
+            value = results.get(name, {}).get(metric)
+            if value is not None and value > limit:
+                failures.append(f"{name}.{metric} = {value} exceeds threshold {limit}")
+    for name, previous in (baseline or {}).items():
+        for metric in REGRESSION_METRICS:
+            value, reference = results.get(name, {}).get(metric), previous.get(metric)
+            if value is not None and reference and value > reference * (1 + max_regression):
+                failures.append(f"{name}.{metric} = {value} regressed more than {max_regression:.0%} from {reference}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="Write results JSON here instead of stdout.")
+    parser.add_argument("--quick", action="store_true", help="Shorter sessions and fewer repeats.")
+    parser.add_argument("--thresholds", default=THRESHOLDS_PATH, help="JSON of per-benchmark metric upper bounds.")
+    parser.add_argument("--baseline", help="Earlier results JSON to compare against.")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="Allowed relative slowdown against the baseline.")
+    args = parser.parse_args()
+
+    results = run_suite(args.quick)
+    with open(args.thresholds, encoding="utf-8") as f:
+        thresholds = json.load(f)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["benchmarks"]
+    failures = check_results(results, thresholds, baseline, args.max_regression)
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "quick": args.quick,
+        },
+        "benchmarks": results,
+        "failures": failures,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,143 @@
-import openai
 import os
 import json
+import math
+import re
+import zlib
+import hashlib
+import sqlite3
+import time
+import asyncio
+import inspect
+import threading
+import typing
+import weakref
+from typing import Annotated, List, Literal, Optional, Required, TypedDict
+from collections import OrderedDict
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import tiktoken
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+import tracing
+from llm_transport import LLMError, default_transport
 
-TODO_FILE = "todos.json"
+# Every LLM call in this module goes through llm_backend; swap it with set_llm_backend(),
+# e.g. for a ScriptedBackend when benchmarking offline.
+llm_backend = default_transport
 
-main_agent_history = []
-technical_support_history = []
-billing_history = []
+def set_llm_backend(backend):
+    global llm_backend
+    llm_backend = backend
+
+SESSION_DIR = "sessions"
+DEFAULT_SESSION_ID = "default"
+MAX_ACTIVE_SESSIONS = 1000
+SESSION_IDLE_SECONDS = 1800
 
 CONTEXT_WINDOW_LIMIT = 128000
 CONTEXT_THRESHOLD = 0.7
+COMPACTION_WATERMARK = 0.5
+VERBATIM_TAIL_TOKENS = 8000
+SUMMARY_FANOUT = 4
+COMPACTION_WORKERS = 4
+
+TECHNICAL_SUPPORT_MEMORY_TOKENS = 16000
+BILLING_MEMORY_TOKENS = 12000
+SUB_AGENT_TAIL_TOKENS = 4000
+
+RESPONSE_CACHE_TTL_SECONDS = 3600
+RESPONSE_CACHE_MAX_ENTRIES = 2048
+RESPONSE_CACHE_SIMILARITY = None  # Opt-in, e.g. 0.9; exact matches only by default
+RESPONSE_CACHE_HISTORY_WINDOW = 2
+HASHING_VECTOR_DIMENSIONS = 4096
+HASHING_NGRAM_SIZE = 3
+
+DEFAULT_TOOL_CONCURRENCY = 8
+DEFAULT_TOOL_TIMEOUT_SECONDS = 30
+TOOL_RETRY_BACKOFF_SECONDS = 0.5
 TOKENIZER = tiktoken.encoding_for_model("gpt-4o")
 
+def count_text_tokens(text):
+    if not text:
+        return 0
+    if not isinstance(text, str):
+        text = json.dumps(text)
+    return len(TOKENIZER.encode(text))
+
+def count_message_tokens(msg):
+    tokens = count_text_tokens(msg.get("content"))
+    for tool_call in msg.get("tool_calls") or []:
+        function = tool_call["function"]
+        tokens += count_text_tokens(function["name"]) + count_text_tokens(function["arguments"])
+    return tokens
+
 def estimate_tokens(messages):
-    total_tokens = 0
-    for msg in messages:
-        content = msg.get("content", "")
-        if isinstance(content, dict):
-            content = json.dumps(content)
-        total_tokens += len(TOKENIZER.encode(content))
-    return total_tokens
-
-def summarize_chat_history(history):
-    history_str = json.dumps(history, indent=2)
-    response = openai.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {
-                "role": "system",
-                "content": (
+    return sum(count_message_tokens(msg) for msg in messages)
+
+class TokenTrackedHistory:
+    """Chat history that caches per-message token counts and keeps a running total.
+
+    base_tokens covers the parts of every request that never change (system prompt, tool schemas),
+    so they are counted once instead of on every budget check.
+    """
+
+    def __init__(self, base_tokens=0, messages=None):
+        self.base_tokens = base_tokens
+        self.messages = []
+        self.message_tokens = []
+        self.history_tokens = 0
+        self.version = 0
+        for msg in messages or []:
+            self.append(msg)
+
+    @property
+    def total_tokens(self):
+        return self.base_tokens + self.history_tokens
+
+    def append(self, msg):
+        tokens = count_message_tokens(msg)
+        self.messages.append(msg)
+        self.message_tokens.append(tokens)
+        self.history_tokens += tokens
+
+    def replace_prefix(self, count, messages):
+        tail = self.messages[count:]
+        tail_tokens = self.message_tokens[count:]
+        self.messages = []
+        self.message_tokens = []
+        self.history_tokens = 0
+        self.version += 1
+        for msg in messages:
+            self.append(msg)
+        self.messages.extend(tail)
+        self.message_tokens.extend(tail_tokens)
+        self.history_tokens += sum(tail_tokens)
+
+    def exceeds(self, limit):
+        return self.total_tokens > limit
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+API_MESSAGE_KEYS = ("role", "content", "tool_calls", "tool_call_id", "name")
+
+def to_api_message(msg):
+    return {key: msg[key] for key in API_MESSAGE_KEYS if msg.get(key) is not None}
+
+SUPER_SUMMARY_PROMPT = (
+    "You are an expert summarizer for a customer service system. You are given consecutive summaries of an ongoing customer conversation, oldest first."
+    " Merge them into a single concise narrative that keeps every open issue, task status, sub-agent outcome and customer commitment."
+    " Drop details that later summaries supersede."
+)
+
+def summarize_chat_history(history, tier=0):
+    history_str = json.dumps([to_api_message(msg) for msg in history], separators=(",", ":"))
+    system_content = SUPER_SUMMARY_PROMPT if tier > 0 else (
                     "You are an expert summarizer for a customer service system. Summarize the provided chat history into a concise, clear narrative  that retains critical details for ongoing interactions. Include:"
                     "\n- Key customer queries and their context (e.g., specific issues like billing errors or technical problems)."
                     "\n- Tasks created, their status (pending, in_progress, completed), and priorities."
@@ -40,171 +145,724 @@ def summarize_chat_history(history):
                     "\n- Current progress and unresolved issues."
                     "\n- Relevant outcomes (e.g., refunds issued, solutions provided)."
                     "\nExclude redundant details, internal tool call data, and timestamps unless critical. Ensure the summary is professional, focused, and suitable for maintaining conversation continuity."
-                )
-            },
-            {"role": "user", "content": f"Summarize this chat history:\n{history_str}"}
-        ]
     )
+    with tracing.span("history.summarize", tier=tier, messages=len(history)):
+        response = llm_backend.chat_sync(
+            messages=[
+                {"role": "system", "content": system_content},
+                {"role": "user", "content": f"Summarize this chat history:\n{history_str}"}
+            ],
+            model="gpt-4o"
+        )
     summary = response.choices[0].message.content
-    return [{
+    return {
         "role": "system",
         "content": f"Summarized chat history: {summary}",
+        "summary_tier": tier,
         "timestamp": datetime.now().isoformat()
-    }]
+    }
 
-def load_todos():
-    if os.path.exists(TODO_FILE):
-        with open(TODO_FILE, "r") as f:
-            return json.load(f)
-    return []
+def fold_summaries(summaries, summary_fanout=SUMMARY_FANOUT):
+    # Higher tiers cover older spans of the conversation, so they sort first.
+    tier = 0
+    while any(msg["summary_tier"] >= tier for msg in summaries):
+        level = [msg for msg in summaries if msg["summary_tier"] == tier]
+        if len(level) > summary_fanout:
+            merged = summarize_chat_history(level, tier=tier + 1)
+            summaries = [msg for msg in summaries if msg["summary_tier"] != tier] + [merged]
+        tier += 1
+    return sorted(summaries, key=lambda msg: -msg["summary_tier"])
 
-def save_todos(todos):
-    with open(TODO_FILE, "w") as f:
-        json.dump(todos, f, indent=4)
+def compact_history_prefix(prefix, summary_fanout=SUMMARY_FANOUT):
+    summaries = [msg for msg in prefix if "summary_tier" in msg]
+    raw = [msg for msg in prefix if "summary_tier" not in msg]
+    if raw:
+        summaries.append(summarize_chat_history(raw))
+    return fold_summaries(summaries, summary_fanout)
 
-def todo_write(todos):
-    save_todos(todos)
-    return {"success": True, "message": "Todo list updated and persisted to file."}
+def find_compaction_cut(history, tail_tokens):
+    # Keep the newest messages verbatim within tail_tokens. The cut must land on a user or
+    # assistant message so an assistant message is never separated from its tool_call_id replies,
+    # including replies that are appended while the summary is still being produced.
+    messages = history.messages
+    cut = len(messages)
+    kept_tokens = 0
+    while cut > 0 and kept_tokens + history.message_tokens[cut - 1] <= tail_tokens:
+        cut -= 1
+        kept_tokens += history.message_tokens[cut]
+    while cut < len(messages) and messages[cut]["role"] == "tool":
+        cut += 1
+    if cut == len(messages):
+        cut -= 1
+        while cut > 0 and messages[cut]["role"] == "tool":
+            cut -= 1
+    first_raw = 0
+    while first_raw < len(messages) and "summary_tier" in messages[first_raw]:
+        first_raw += 1
+    return cut if cut > first_raw else None
 
-def todo_read():
-    todos = load_todos()
-    return {"todos": todos}
+compaction_executor = ThreadPoolExecutor(max_workers=COMPACTION_WORKERS)
 
-def consult_technical_support(query):
-    technical_support_history.append({
-        "role": "user",
-        "content": query,
-        "timestamp": datetime.now().isoformat()
-    })
-    response = openai.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are a technical support specialist. Provide detailed technical assistance based on the query, using the provided conversation history for context."}
-        ] + technical_support_history
-    )
-    response_content = response.choices[0].message.content
-    technical_support_history.append({
-        "role": "assistant",
-        "content": response_content,
-        "timestamp": datetime.now().isoformat()
-    })
-    return {"response": response_content}
+class HistoryCompactor:
+    """Summarizes the oldest segment of a TokenTrackedHistory ahead of time.
 
-def consult_billing(query):
-    billing_history.append({
-        "role": "user",
-        "content": query,
-        "timestamp": datetime.now().isoformat()
-    })
-    response = openai.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are a billing specialist. Handle queries related to payments, invoices, refunds, and account balances, using the provided conversation history for context."}
-        ] + billing_history
-    )
-    response_content = response.choices[0].message.content
-    billing_history.append({
-        "role": "assistant",
-        "content": response_content,
-        "timestamp": datetime.now().isoformat()
-    })
-    return {"response": response_content}
-
-tools = [
-    {
-        "type": "function",
-        "function": {
-            "name": "todo_write",
-            "description": "Create or update the structured task list for the current customer service session. This helps track progress, organize complex queries, and provide visibility to the customer. Persists to a file.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "todos": {
-                        "type": "array",
-                        "description": "The full list of todo items to set (overwrites existing list).",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "id": {
-                                    "type": "string",
-                                    "description": "Unique ID for the task (e.g., 'task1')."
-                                },
-                                "content": {
-                                    "type": "string",
-                                    "description": "Description of the task."
-                                },
-                                "status": {
-                                    "type": "string",
-                                    "enum": ["pending", "in_progress", "completed"],
-                                    "description": "Status of the task."
-                                },
-                                "priority": {
-                                    "type": "string",
-                                    "enum": ["high", "medium", "low"],
-                                    "description": "Priority of the task."
-                                }
-                            },
-                            "required": ["id", "content", "status", "priority"]
-                        }
-                    }
-                },
-                "required": ["todos"]
-            }
+    Crossing watermark_tokens schedules a background summary of everything older than the
+    verbatim tail; only crossing limit_tokens makes the caller wait for it.
+    """
+
+    def __init__(self, history, watermark_tokens, limit_tokens, tail_tokens=VERBATIM_TAIL_TOKENS, summary_fanout=SUMMARY_FANOUT, executor=None):
+        self.history = history
+        self.watermark_tokens = watermark_tokens
+        self.limit_tokens = limit_tokens
+        self.tail_tokens = tail_tokens
+        self.summary_fanout = summary_fanout
+        self._executor = executor or compaction_executor
+        self._pending = None
+
+    def maintain(self):
+        self._apply_finished(wait=False)
+        if self.history.exceeds(self.limit_tokens):
+            if self._pending is None:
+                self._schedule()
+            self._apply_finished(wait=True)
+        elif self.history.exceeds(self.watermark_tokens) and self._pending is None:
+            self._schedule()
+
+    def flush(self):
+        self._apply_finished(wait=True)
+
+    def _schedule(self):
+        cut = find_compaction_cut(self.history, self.tail_tokens)
+        if cut is None:
+            return
+        prefix = self.history.messages[:cut]
+        future = self._executor.submit(compact_history_prefix, prefix, self.summary_fanout)
+        self._pending = (future, cut, self.history.version)
+
+    def _apply_finished(self, wait):
+        if self._pending is None:
+            return
+        future, cut, version = self._pending
+        if not wait and not future.done():
+            return
+        self._pending = None
+        try:
+            new_prefix = future.result()
+        except Exception as e:
+            print(f"Error compacting chat history: {e}")
+            return
+        if version == self.history.version:
+            self.history.replace_prefix(cut, new_prefix)
+
+class SlidingWindow:
+    """Drops the oldest messages once a history exceeds limit_tokens, keeping tail_tokens verbatim."""
+
+    def __init__(self, history, limit_tokens, tail_tokens):
+        self.history = history
+        self.limit_tokens = limit_tokens
+        self.tail_tokens = tail_tokens
+
+    def maintain(self):
+        if not self.history.exceeds(self.limit_tokens):
+            return
+        cut = find_compaction_cut(self.history, self.tail_tokens)
+        if cut is not None:
+            summaries = [msg for msg in self.history.messages[:cut] if "summary_tier" in msg]
+            self.history.replace_prefix(cut, summaries)
+
+    def flush(self):
+        pass
+
+class MemoryPolicy:
+    """Token budget for one agent's history and what happens to turns that fall out of it.
+
+    With summarize_evicted the oldest turns are summarized ahead of time by a HistoryCompactor once
+    watermark_ratio of the budget is used; otherwise they are dropped by a SlidingWindow.
+    """
+
+    def __init__(self, budget_tokens, tail_tokens, watermark_ratio=COMPACTION_WATERMARK / CONTEXT_THRESHOLD, summarize_evicted=True, summary_fanout=SUMMARY_FANOUT):
+        self.budget_tokens = budget_tokens
+        self.tail_tokens = tail_tokens
+        self.watermark_ratio = watermark_ratio
+        self.summarize_evicted = summarize_evicted
+        self.summary_fanout = summary_fanout
+
+    def compactor_for(self, history):
+        if not self.summarize_evicted:
+            return SlidingWindow(history, self.budget_tokens, self.tail_tokens)
+        return HistoryCompactor(
+            history,
+            watermark_tokens=self.budget_tokens * self.watermark_ratio,
+            limit_tokens=self.budget_tokens,
+            tail_tokens=self.tail_tokens,
+            summary_fanout=self.summary_fanout
+        )
+
+class AgentMemory:
+    def __init__(self, policy, base_tokens, messages=None):
+        self.history = TokenTrackedHistory(base_tokens=base_tokens, messages=messages)
+        self.compactor = policy.compactor_for(self.history)
+
+MAIN_AGENT_MEMORY = MemoryPolicy(CONTEXT_WINDOW_LIMIT * CONTEXT_THRESHOLD, VERBATIM_TAIL_TOKENS)
+
+TODO_FIELDS = ("id", "content", "status", "priority")
+
+class TodoStore:
+    """SQLite-backed todo list with an in-memory index by id and status.
+
+    Each write touches only the rows that change and commits atomically. Reads are served from
+    the index, which is reloaded only when another connection has committed since the last load
+    (detected with PRAGMA data_version).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._data_version = None
+        self._items = {}
+        self._positions = {}
+        self._next_position = 0
+        self._by_status = {}
+        self._snapshot = None
+
+    def list(self, status=None, priority=None):
+        with self._lock:
+            self._refresh()
+            if self._snapshot is None:
+                self._snapshot = list(self._items.values())
+            if status is None and priority is None:
+                return self._snapshot
+            ids = self._by_status.get(status, ()) if status is not None else self._items
+            matches = [
+                self._items[todo_id] for todo_id in ids
+                if priority is None or self._items[todo_id]["priority"] == priority
+            ]
+            return sorted(matches, key=lambda todo: self._positions[todo["id"]])
+
+    def get(self, todo_id):
+        with self._lock:
+            self._refresh()
+            return self._items.get(todo_id)
+
+    def replace_all(self, todos):
+        with self._lock:
+            with self._connection() as conn:
+                conn.execute("DELETE FROM todos")
+                conn.executemany(
+                    "INSERT INTO todos (id, position, content, status, priority) VALUES (?, ?, ?, ?, ?)",
+                    [(todo["id"], position, todo["content"], todo["status"], todo["priority"]) for position, todo in enumerate(todos)]
+                )
+            self._items = {}
+            self._positions = {}
+            self._next_position = 0
+            self._by_status = {}
+            for todo in todos:
+                self._index({field: todo[field] for field in TODO_FIELDS})
+
+    def upsert(self, todo):
+        todo = {field: todo[field] for field in TODO_FIELDS}
+        with self._lock:
+            self._refresh()
+            with self._connection() as conn:
+                conn.execute(
+                    "INSERT INTO todos (id, position, content, status, priority) "
+                    "VALUES (?, (SELECT COALESCE(MAX(position), -1) + 1 FROM todos), ?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET content = excluded.content, status = excluded.status, priority = excluded.priority",
+                    (todo["id"], todo["content"], todo["status"], todo["priority"])
+                )
+            self._unindex(todo["id"])
+            self._index(todo)
+
+    def update(self, todo_id, **fields):
+        with self._lock:
+            self._refresh()
+            if todo_id not in self._items:
+                return None
+            todo = dict(self._items[todo_id], **{key: value for key, value in fields.items() if key in TODO_FIELDS and key != "id"})
+            with self._connection() as conn:
+                conn.execute(
+                    "UPDATE todos SET content = ?, status = ?, priority = ? WHERE id = ?",
+                    (todo["content"], todo["status"], todo["priority"], todo_id)
+                )
+            self._unindex(todo_id)
+            self._index(todo)
+            return todo
+
+    def remove(self, todo_id):
+        with self._lock:
+            self._refresh()
+            if todo_id not in self._items:
+                return False
+            with self._connection() as conn:
+                conn.execute("DELETE FROM todos WHERE id = ?", (todo_id,))
+            self._unindex(todo_id)
+            del self._items[todo_id]
+            del self._positions[todo_id]
+            return True
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+                self._data_version = None
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS todos ("
+                "id TEXT PRIMARY KEY, position INTEGER NOT NULL, content TEXT NOT NULL, status TEXT NOT NULL, priority TEXT NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _refresh(self):
+        conn = self._connection()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        self._items = {}
+        self._positions = {}
+        self._next_position = 0
+        self._by_status = {}
+        for row in conn.execute("SELECT id, content, status, priority FROM todos ORDER BY position"):
+            self._index(dict(zip(TODO_FIELDS, row)))
+        self._data_version = data_version
+
+    def _index(self, todo):
+        if todo["id"] not in self._positions:
+            self._positions[todo["id"]] = self._next_position
+            self._next_position += 1
+        self._items[todo["id"]] = todo
+        self._by_status.setdefault(todo["status"], set()).add(todo["id"])
+        self._snapshot = None
+
+    def _unindex(self, todo_id):
+        todo = self._items.get(todo_id)
+        if todo is not None:
+            self._by_status[todo["status"]].discard(todo_id)
+        self._snapshot = None
+
+class ToolArgumentError(ValueError):
+    pass
+
+JSON_SCALAR_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean"}
+
+def json_schema_for(hint):
+    origin = typing.get_origin(hint)
+    args = typing.get_args(hint)
+    if origin is Annotated:
+        schema = json_schema_for(args[0])
+        return dict(schema, description=args[1])
+    if origin is Required:
+        return json_schema_for(args[0])
+    if origin is typing.Union and type(None) in args:
+        return json_schema_for(next(arg for arg in args if arg is not type(None)))
+    if origin is Literal:
+        return {"type": JSON_SCALAR_TYPES[type(args[0])], "enum": list(args)}
+    if origin in (list, List):
+        return {"type": "array", "items": json_schema_for(args[0])}
+    if typing.is_typeddict(hint):
+        hints = typing.get_type_hints(hint, include_extras=True)
+        return {
+            "type": "object",
+            "properties": {name: json_schema_for(field) for name, field in hints.items()},
+            "required": [name for name in hints if name in hint.__required_keys__]
         }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "todo_read",
-            "description": "Read the current todo list for the session from the persisted file. Use this frequently to check progress and plan next steps. Takes no parameters.",
-            "parameters": {
-                "type": "object",
-                "properties": {}
-            }
+    return {"type": JSON_SCALAR_TYPES[hint]}
+
+def compile_validator(schema, path="arguments"):
+    # Builds the checks for a schema once, so validating a call is a walk over closures.
+    schema_type = schema["type"]
+    if schema_type == "object":
+        fields = {name: compile_validator(field, f"{path}.{name}") for name, field in schema["properties"].items()}
+        required = schema.get("required", [])
+
+        def validate_object(value):
+            if not isinstance(value, dict):
+                raise ToolArgumentError(f"{path} must be an object")
+            for name in required:
+                if name not in value:
+                    raise ToolArgumentError(f"{path}.{name} is required")
+            for name, field_value in value.items():
+                if name in fields and not (field_value is None and name not in required):
+                    fields[name](field_value)
+        return validate_object
+    if schema_type == "array":
+        validate_item = compile_validator(schema["items"], f"{path}[]")
+
+        def validate_array(value):
+            if not isinstance(value, list):
+                raise ToolArgumentError(f"{path} must be an array")
+            for item in value:
+                validate_item(item)
+        return validate_array
+    python_type = {"string": str, "integer": int, "number": (int, float), "boolean": bool}[schema_type]
+    allowed = frozenset(schema["enum"]) if "enum" in schema else None
+
+    def validate_scalar(value):
+        if not isinstance(value, python_type):
+            raise ToolArgumentError(f"{path} must be a {schema_type}")
+        if allowed is not None and value not in allowed:
+            raise ToolArgumentError(f"{path} must be one of {sorted(allowed)}")
+    return validate_scalar
+
+class ToolSpec:
+    def __init__(self, function, name, description, parameters, resource, timeout, retries, max_concurrency):
+        self.function = function
+        self.name = name
+        self.description = description
+        self.parameters = parameters
+        self.resource = resource
+        self.timeout = timeout
+        self.retries = retries
+        self.max_concurrency = max_concurrency
+        self.validate = compile_validator(parameters)
+        # asyncio semaphores belong to one event loop; asyncio.run() callers get one per loop
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def schema(self):
+        return {
+            "type": "function",
+            "function": {"name": self.name, "description": self.description, "parameters": self.parameters}
         }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "consult_technical_support",
-            "description": "Delegate a query to the technical support sub-agent for specialized technical assistance.",
-            "parameters": {
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+            return semaphore
+
+    async def invoke(self, session, arguments):
+        # Calls wait for a slot on the loop, not in a worker thread, and the timeout starts once they hold one.
+        # A timed-out call keeps its slot until its thread actually finishes.
+        semaphore = self._semaphore()
+        await semaphore.acquire()
+        call = asyncio.ensure_future(asyncio.to_thread(self.function, session, **arguments))
+
+        def release(call):
+            semaphore.release()
+            if not call.cancelled():
+                call.exception()  # Retrieved so a timed-out call's failure is not logged as unhandled
+
+        call.add_done_callback(release)
+        return await asyncio.wait_for(asyncio.shield(call), self.timeout)
+
+class ToolRegistry:
+    """Tools the main agent can call, keyed by name.
+
+    The register decorator builds each tool's JSON schema from its type hints and docstring once,
+    at import time. Parameters after the leading session argument become tool arguments; wrap a
+    hint in Annotated[..., "description"] to describe it. Calls that share a resource run in their
+    original order, calls on different resources run concurrently.
+    """
+
+    def __init__(self):
+        self._tools = {}
+        self._schemas = None
+
+    def register(self, name=None, resource=None, timeout=DEFAULT_TOOL_TIMEOUT_SECONDS, retries=0, max_concurrency=DEFAULT_TOOL_CONCURRENCY):
+        def decorator(function):
+            tool_name = name or function.__name__
+            hints = typing.get_type_hints(function, include_extras=True)
+            parameters = list(inspect.signature(function).parameters.values())[1:]
+            schema = {
                 "type": "object",
-                "properties": {
-                    "query": {
-                        "type": "string",
-                        "description": "The query to send to the technical support sub-agent."
-                    }
-                },
-                "required": ["query"]
+                "properties": {param.name: json_schema_for(hints[param.name]) for param in parameters}
             }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "consult_billing",
-            "description": "Delegate a query to the billing sub-agent for handling payments, invoices, or account-related issues.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "query": {
-                        "type": "string",
-                        "description": "The query to send to the billing sub-agent."
-                    }
-                },
-                "required": ["query"]
+            required = [param.name for param in parameters if param.default is inspect.Parameter.empty]
+            if required:
+                schema["required"] = required
+            self._tools[tool_name] = ToolSpec(
+                function,
+                tool_name,
+                inspect.cleandoc(function.__doc__ or ""),
+                schema,
+                resource or tool_name,
+                timeout,
+                retries,
+                max_concurrency
+            )
+            self._schemas = None
+            return function
+        return decorator
+
+    def get(self, name):
+        return self._tools.get(name)
+
+    def schemas(self):
+        if self._schemas is None:
+            self._schemas = [spec.schema() for spec in self._tools.values()]
+        return self._schemas
+
+tool_registry = ToolRegistry()
+
+TaskStatus = Literal["pending", "in_progress", "completed"]
+TaskPriority = Literal["high", "medium", "low"]
+
+class TodoItem(TypedDict):
+    id: Annotated[str, "Unique ID for the task (e.g., 'task1')."]
+    content: Annotated[str, "Description of the task."]
+    status: Annotated[TaskStatus, "Status of the task."]
+    priority: Annotated[TaskPriority, "Priority of the task."]
+
+class TodoPatch(TypedDict, total=False):
+    id: Required[Annotated[str, "ID of the task to change."]]
+    content: Annotated[str, "New description of the task."]
+    status: Annotated[TaskStatus, "New status of the task."]
+    priority: Annotated[TaskPriority, "New priority of the task."]
+
+@tool_registry.register(resource="todos")
+def todo_write(session, todos: Annotated[List[TodoItem], "The full list of todo items to set (overwrites existing list)."]):
+    """Replace the whole structured task list for the current customer service session. Use only to create the initial list or to rewrite it wholesale; prefer todo_add, todo_update and todo_remove for changes. Persists to a file."""
+    session.todos.replace_all(todos)
+    return {"success": True, "message": "Todo list updated and persisted to file."}
+
+@tool_registry.register(resource="todos")
+def todo_read(
+    session,
+    status: Annotated[Optional[TaskStatus], "Only return tasks with this status."] = None,
+    priority: Annotated[Optional[TaskPriority], "Only return tasks with this priority."] = None
+):
+    """Read the current todo list for the session from the persisted file. Use this frequently to check progress and plan next steps. Optionally filter by status and/or priority to get only the matching items."""
+    todos = session.todos.list(status=status, priority=priority)
+    return {"todos": todos}
+
+@tool_registry.register(resource="todos")
+def todo_add(session, todos: Annotated[List[TodoItem], "The todo items to add."]):
+    """Add new tasks to the session's todo list, or overwrite tasks with the same id. Other tasks are left untouched."""
+    for todo in todos:
+        session.todos.upsert(todo)
+    return {"success": True, "added": [todo["id"] for todo in todos]}
+
+@tool_registry.register(resource="todos")
+def todo_update(session, updates: Annotated[List[TodoPatch], "Patches to apply, one per task."]):
+    """Change fields of existing tasks by id, e.g. mark one task as in_progress or completed. Only the fields given are changed."""
+    updated = []
+    missing = []
+    for update in updates:
+        fields = {key: value for key, value in update.items() if key != "id"}
+        if session.todos.update(update["id"], **fields) is None:
+            missing.append(update["id"])
+        else:
+            updated.append(update["id"])
+    result = {"success": not missing, "updated": updated}
+    if missing:
+        result["unknown_ids"] = missing
+    return result
+
+@tool_registry.register(resource="todos")
+def todo_remove(session, ids: Annotated[List[str], "IDs of the tasks to remove."]):
+    """Remove tasks from the session's todo list by id."""
+    removed = [todo_id for todo_id in ids if session.todos.remove(todo_id)]
+    result = {"success": len(removed) == len(ids), "removed": removed}
+    if len(removed) != len(ids):
+        result["unknown_ids"] = [todo_id for todo_id in ids if todo_id not in removed]
+    return result
+
+def normalize_query(query):
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+def hash_history(history, window=RESPONSE_CACHE_HISTORY_WINDOW):
+    recent = [(msg["role"], msg.get("content")) for msg in history[-window:]] if window else []
+    return hashlib.sha256(json.dumps(recent).encode()).hexdigest()
+
+# "don't" normalizes to "don t", so "t" covers the contracted negations
+NEGATION_TOKENS = frozenset({"no", "not", "never", "nor", "without", "cannot", "t"})
+
+def guard_tokens(normalized):
+    # Numbers (order ids, amounts, dates) and negations change the answer while barely moving the
+    # n-gram similarity, so a similar match must agree on them exactly.
+    return frozenset(token for token in normalized.split() if token.isdigit() or token in NEGATION_TOKENS)
+
+def hashing_vector(text, ngram_size=HASHING_NGRAM_SIZE, dimensions=HASHING_VECTOR_DIMENSIONS):
+    # Character n-grams hashed into a fixed number of buckets, L2-normalized; needs no model or network.
+    padded = f" {text} "
+    counts = {}
+    for i in range(max(len(padded) - ngram_size + 1, 1)):
+        bucket = zlib.crc32(padded[i:i + ngram_size].encode()) % dimensions
+        counts[bucket] = counts.get(bucket, 0) + 1
+    norm = math.sqrt(sum(count * count for count in counts.values()))
+    return {bucket: count / norm for bucket, count in counts.items()}
+
+def cosine_similarity(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(bucket, 0.0) for bucket, weight in a.items())
+
+class ResponseCache:
+    """Caches sub-agent responses by normalized query and recent-history hash.
+
+    Exact matches are a dict lookup. When similarity_threshold is set, a miss falls back to the
+    closest cached query with the same agent and history hash, compared as hashed n-gram vectors.
+    A similar match must contain the same numbers and negations as the query.
+    Entries expire after ttl_seconds and the least recently used ones are evicted past max_entries.
+    """
+
+    def __init__(self, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS, max_entries=RESPONSE_CACHE_MAX_ENTRIES, similarity_threshold=RESPONSE_CACHE_SIMILARITY, history_window=RESPONSE_CACHE_HISTORY_WINDOW):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.history_window = history_window
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "similar_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def lookup(self, agent_name, query, history):
+        normalized = normalize_query(query)
+        bucket = (agent_name, hash_history(history, self.history_window))
+        with self._lock:
+            key = bucket + (normalized,)
+            entry = self._live_entry(key)
+            if entry is not None:
+                self._metrics["hits"] += 1
+                return entry["response"]
+            if self.similarity_threshold is not None:
+                vector = hashing_vector(normalized)
+                guards = guard_tokens(normalized)
+                best_key, best_score = None, self.similarity_threshold
+                for candidate_key in list(self._buckets.get(bucket, ())):
+                    candidate = self._live_entry(candidate_key, touch=False)
+                    if candidate is None or candidate["guards"] != guards:
+                        continue
+                    score = cosine_similarity(vector, candidate["vector"])
+                    if score >= best_score:
+                        best_key, best_score = candidate_key, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self._metrics["similar_hits"] += 1
+                    return self._entries[best_key]["response"]
+            self._metrics["misses"] += 1
+            return None
+
+    def store(self, agent_name, query, history, response):
+        normalized = normalize_query(query)
+        bucket = (agent_name, hash_history(history, self.history_window))
+        key = bucket + (normalized,)
+        with self._lock:
+            self._entries[key] = {
+                "response": response,
+                "vector": hashing_vector(normalized),
+                "guards": guard_tokens(normalized),
+                "expires_at": time.monotonic() + self.ttl_seconds
             }
+            self._entries.move_to_end(key)
+            self._buckets.setdefault(bucket, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self._metrics["evictions"] += 1
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics, size=len(self._entries))
+        lookups = metrics["hits"] + metrics["similar_hits"] + metrics["misses"]
+        metrics["hit_rate"] = (metrics["hits"] + metrics["similar_hits"]) / lookups if lookups else 0.0
+        return metrics
+
+    def _live_entry(self, key, touch=True):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires_at"] < time.monotonic():
+            self._remove(key)
+            self._metrics["expirations"] += 1
+            return None
+        if touch:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        del self._entries[key]
+        bucket = self._buckets[key[:2]]
+        bucket.discard(key)
+        if not bucket:
+            del self._buckets[key[:2]]
+
+response_cache = ResponseCache()
+
+class SubAgent:
+    """A specialist the main agent can consult, with its own instructions and memory policy."""
+
+    def __init__(self, name, instructions, memory_policy):
+        self.name = name
+        self.instructions = instructions
+        self.memory_policy = memory_policy
+        self.base_tokens = count_text_tokens(instructions)
+
+    def consult(self, session, query):
+        memory = session.sub_agent_memory(self)
+        history = memory.history
+        cached = response_cache.lookup(self.name, query, history)
+        tracing.current_span().set_attributes({"agent": self.name, "cache_hit": cached is not None})
+        user_message = {
+            "role": "user",
+            "content": query,
+            "timestamp": datetime.now().isoformat()
         }
-    }
-]
+        # The query is only recorded once the call succeeds, so a retried call does not repeat it.
+        if cached is not None:
+            response_content = cached
+        else:
+            response = llm_backend.chat_sync(
+                messages=[
+                    {"role": "system", "content": self.instructions}
+                ] + [to_api_message(msg) for msg in history] + [to_api_message(user_message)],
+                model="gpt-4o"
+            )
+            response_content = response.choices[0].message.content
+            response_cache.store(self.name, query, history, response_content)
+        history.append(user_message)
+        history.append({
+            "role": "assistant",
+            "content": response_content,
+            "timestamp": datetime.now().isoformat()
+        })
+        memory.compactor.maintain()
+        return {"response": response_content}
+
+technical_support_agent = SubAgent(
+    "technical_support",
+    "You are a technical support specialist. Provide detailed technical assistance based on the query, using the provided conversation history for context.",
+    MemoryPolicy(TECHNICAL_SUPPORT_MEMORY_TOKENS, SUB_AGENT_TAIL_TOKENS)
+)
+
+billing_agent = SubAgent(
+    "billing",
+    "You are a billing specialist. Handle queries related to payments, invoices, refunds, and account balances, using the provided conversation history for context.",
+    MemoryPolicy(BILLING_MEMORY_TOKENS, SUB_AGENT_TAIL_TOKENS)
+)
+
+@tool_registry.register(resource="technical_support", timeout=120, retries=2, max_concurrency=4)
+def consult_technical_support(session, query: Annotated[str, "The query to send to the technical support sub-agent."]):
+    """Delegate a query to the technical support sub-agent for specialized technical assistance."""
+    return technical_support_agent.consult(session, query)
+
+@tool_registry.register(resource="billing", timeout=120, retries=2, max_concurrency=4)
+def consult_billing(session, query: Annotated[str, "The query to send to the billing sub-agent."]):
+    """Delegate a query to the billing sub-agent for handling payments, invoices, or account-related issues."""
+    return billing_agent.consult(session, query)
+
+tools = tool_registry.schemas()
 
 system_prompt = """
 You are a professional customer service agent designed to resolve queries efficiently across multiple conversation turns. You have access to specialized tools for task management and sub-agents for executing specific tasks. Separate in-memory chat histories are maintained for the main agent and each sub-agent to provide context for ongoing conversations.
 
 ## Task Management Tools
-- **todo_write**: Create or update a structured task list for the session, persisted to a file. Use this to plan and track progress.
-- **todo_read**: Retrieve the current task list from the file. Use this to review progress and plan next steps.
+- **todo_write**: Create the structured task list for the session, persisted to a file. Use this to plan, or to rewrite the whole list.
+- **todo_add**: Add tasks to the existing list without resending it.
+- **todo_update**: Change the status, priority or description of specific tasks by id (e.g., mark one task completed).
+- **todo_remove**: Remove tasks by id.
+- **todo_read**: Retrieve the current task list from the file, optionally filtered by status or priority. Use this to review progress and plan next steps.
 
 Use these task management tools frequently to ensure accurate tracking and transparency with the customer. They are essential for breaking down complex queries into manageable steps and preventing oversight.
 
@@ -212,9 +870,9 @@ Use these task management tools frequently to ensure accurate tracking and trans
 - For complex, multi-step queries (e.g., troubleshooting requiring verification and resolution)
 - When queries involve multiple domains (e.g., technical and billing)
 - On receiving a new query: Create a todo list with todo_write
-- Before starting a task: Use todo_read to review, then mark as in_progress with todo_write
-- After completing a task: Mark as completed with todo_write and add follow-up tasks if needed
-- Before deciding next steps: Use todo_read to identify pending tasks
+- Before starting a task: Use todo_read to review, then mark as in_progress with todo_update
+- After completing a task: Mark as completed with todo_update and add follow-up tasks with todo_add if needed
+- Before deciding next steps: Use todo_read with status "pending" to identify pending tasks
 - After updates: Use todo_read to verify changes
 - When responding to the customer: Use todo_read to include progress updates
 - At session start: Use todo_read to check for prior pending tasks
@@ -237,7 +895,7 @@ Use sub-agent tools to execute specific actions required by your todo list. For
 **Agent Response:** "I'll assist you promptly. Here's the plan:"
 - Create tasks with todo_write: Verify account (pending, high), Investigate internet speed (pending, high), Check billing (pending, medium)
 - Delegate tasks to sub-agents (consult_technical_support, consult_billing), which use their own histories
-- Update task statuses with todo_write and review with todo_read
+- Update task statuses with todo_update and review with todo_read
 - Summarize progress in the response
 **Customer Query (Turn 2):** "Any updates on my billing issue?"
 **Agent Response:** Use todo_read to check task status and main agent history (or its summary) for context, then respond with progress (e.g., "Billing issue resolved; refund processed.") and any next steps.
@@ -251,64 +909,378 @@ Use sub-agent tools to execute specific actions required by your todo list. For
 
 """
 
-def handle_customer_query(customer_query):
-    main_agent_history.append({
+BASE_PROMPT_TOKENS = count_text_tokens(system_prompt) + count_text_tokens(json.dumps(tools))
+
+def session_file_prefix(spill_dir, session_id):
+    # The sanitised id keeps files readable; the hash keeps ids like "a/b" and "a_b" apart
+    digest = hashlib.sha256(session_id.encode()).hexdigest()[:16]
+    return os.path.join(spill_dir, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', session_id)[:64]}-{digest}")
+
+class Session:
+    """Per-customer conversation state: the main agent history, sub-agent memories and todo store."""
+
+    def __init__(self, session_id, spill_dir=SESSION_DIR, main_agent_history=None, sub_agent_histories=None):
+        self.session_id = session_id
+        self.todos = TodoStore(session_file_prefix(spill_dir, session_id) + ".todos.db")
+        main_memory = AgentMemory(MAIN_AGENT_MEMORY, BASE_PROMPT_TOKENS, main_agent_history)
+        self.main_agent_history = main_memory.history
+        self.compactor = main_memory.compactor
+        self.sub_agent_memories = {}
+        self._sub_agent_histories = dict(sub_agent_histories or {})
+        self._lock = threading.Lock()
+        self.active_turns = 0
+        self.last_active = time.monotonic()
+
+    def sub_agent_memory(self, agent):
+        with self._lock:
+            if agent.name not in self.sub_agent_memories:
+                self.sub_agent_memories[agent.name] = AgentMemory(
+                    agent.memory_policy, agent.base_tokens, self._sub_agent_histories.pop(agent.name, None)
+                )
+            return self.sub_agent_memories[agent.name]
+
+    def to_dict(self):
+        self.compactor.flush()
+        sub_agent_histories = dict(self._sub_agent_histories)
+        for name, memory in self.sub_agent_memories.items():
+            memory.compactor.flush()
+            sub_agent_histories[name] = memory.history.messages
+        return {
+            "session_id": self.session_id,
+            "main_agent_history": self.main_agent_history.messages,
+            "sub_agent_histories": sub_agent_histories
+        }
+
+    def close(self):
+        self.todos.close()
+
+    @classmethod
+    def from_dict(cls, data, spill_dir=SESSION_DIR):
+        return cls(
+            data["session_id"],
+            spill_dir=spill_dir,
+            main_agent_history=data["main_agent_history"],
+            sub_agent_histories=data["sub_agent_histories"]
+        )
+
+class SessionManager:
+    """Keeps at most max_active sessions in memory and spills least recently used or idle ones to disk.
+
+    Evicted sessions are spilled on a background thread, outside the manager lock, since writing
+    one out waits for any summary still being produced for it. A session requested again while it
+    is being spilled is reloaded once the spill has finished.
+
+    Turns hold their session with acquire()/release() (or acquire_async()), which count the turn
+    under the manager lock so the session cannot be evicted between lookup and use.
+    """
+
+    def __init__(self, spill_dir=SESSION_DIR, max_active=MAX_ACTIVE_SESSIONS, idle_seconds=SESSION_IDLE_SECONDS):
+        self.spill_dir = spill_dir
+        self.max_active = max_active
+        self.idle_seconds = idle_seconds
+        self._sessions = OrderedDict()
+        self._spilling = {}  # session_id -> threading.Event set once the spill is written
+        self._lock = threading.Lock()
+        self._spill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-spill")
+
+    def get(self, session_id, turn=False):
+        # Without turn=True the session may be evicted as soon as the lock is released; use it to inspect.
+        while True:
+            with self._lock:
+                spilled = self._spilling.get(session_id)
+                if spilled is None:
+                    session = self._sessions.pop(session_id, None)
+                    if session is None:
+                        session = self._load(session_id)
+                    self._sessions[session_id] = session
+                    session.last_active = time.monotonic()
+                    if turn:
+                        session.active_turns += 1
+                    self._evict(keep=session_id)
+                    return session
+            spilled.wait()
+
+    def acquire(self, session_id):
+        return self.get(session_id, turn=True)
+
+    async def acquire_async(self, session_id):
+        # A miss reads the session from disk, and a spill in progress is waited for, so neither runs on the loop.
+        return await asyncio.to_thread(self.acquire, session_id)
+
+    def release(self, session):
+        # Eviction skipped this session while the turn ran, so the capacity check is repeated now.
+        with self._lock:
+            session.active_turns -= 1
+            session.last_active = time.monotonic()
+            self._evict()
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict()
+
+    def wait_for_spills(self):
+        self._spill_executor.submit(lambda: None).result()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _evict(self, keep=None):
+        # Called with the lock held; only picks the sessions to evict and queues their spills.
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            over_capacity = len(self._sessions) > self.max_active
+            if not over_capacity and now - session.last_active <= self.idle_seconds:
+                break
+            if session.active_turns or session_id == keep:
+                continue
+            del self._sessions[session_id]
+            self._spilling[session_id] = threading.Event()
+            self._spill_executor.submit(self._spill_evicted, session)
+
+    def _spill_evicted(self, session):
+        try:
+            self._spill(session)
+        finally:
+            with self._lock:
+                self._spilling.pop(session.session_id).set()
+
+    def _spill_path(self, session_id):
+        return session_file_prefix(self.spill_dir, session_id) + ".session.json"
+
+    def _spill(self, session):
+        path = self._spill_path(session.session_id)
+        tmp_path = path + ".tmp"
+        os.makedirs(self.spill_dir, exist_ok=True)
+        with open(tmp_path, "w") as f:
+            json.dump(session.to_dict(), f)
+        os.replace(tmp_path, path)
+        session.close()
+
+    def _load(self, session_id):
+        path = self._spill_path(session_id)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                return Session.from_dict(json.load(f), spill_dir=self.spill_dir)
+        return Session(session_id, spill_dir=self.spill_dir)
+
+session_manager = SessionManager()
+
+async def run_tool_call(session, tool_call):
+    with tracing.span("tool.call", tool=tool_call["function"]["name"], session_id=session.session_id) as span:
+        result = await invoke_tool_call(session, tool_call)
+        if isinstance(result, dict) and "error" in result:
+            span.set_attribute("error", result["error"])
+        return result
+
+async def invoke_tool_call(session, tool_call):
+    # Timeouts are not retried: the timed-out call may still be running on its worker thread.
+    function_name = tool_call["function"]["name"]
+    spec = tool_registry.get(function_name)
+    if spec is None:
+        return {"error": "Unknown function"}
+    try:
+        function_args = json.loads(tool_call["function"]["arguments"])
+        spec.validate(function_args)
+    except (ValueError, ToolArgumentError) as e:
+        return {"error": f"Invalid arguments for tool {function_name}: {e}"}
+    for attempt in range(spec.retries + 1):
+        tracing.current_span().set_attribute("attempts", attempt + 1)
+        try:
+            return await spec.invoke(session, function_args)
+        except asyncio.TimeoutError:
+            return {"error": f"Tool {function_name} timed out after {spec.timeout} seconds"}
+        except LLMError as e:
+            # The transport has already retried transient LLM failures.
+            return {"error": f"Error executing tool {function_name}: {e}"}
+        except Exception as e:
+            if attempt == spec.retries:
+                return {"error": f"Error executing tool {function_name}: {e}"}
+            await asyncio.sleep(TOOL_RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+class ToolCallDispatcher:
+    """Starts each tool call as soon as it is submitted, chaining calls that share a resource."""
+
+    def __init__(self, session):
+        self.session = session
+        self._tasks = {}
+        self._resource_tails = {}
+
+    def submit(self, tool_call):
+        spec = tool_registry.get(tool_call["function"]["name"])
+        resource = spec.resource if spec is not None else tool_call["function"]["name"]
+        task = asyncio.ensure_future(self._run(tool_call, self._resource_tails.get(resource)))
+        self._resource_tails[resource] = task
+        self._tasks[id(tool_call)] = task
+
+    async def results(self, tool_calls):
+        return await asyncio.gather(*(self._tasks[id(tool_call)] for tool_call in tool_calls))
+
+    async def _run(self, tool_call, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        return await run_tool_call(self.session, tool_call)
+
+async def dispatch_tool_calls(session, tool_calls):
+    dispatcher = ToolCallDispatcher(session)
+    for tool_call in tool_calls:
+        dispatcher.submit(tool_call)
+    return await dispatcher.results(tool_calls)
+
+class ToolCallAssembler:
+    """Rebuilds tool calls from streamed fragments and reports each one once its arguments are complete.
+
+    A call is complete when its arguments parse as a JSON object, when the next call starts,
+    or when the stream ends.
+    """
+
+    def __init__(self):
+        self.tool_calls = []
+        self._completed = set()
+
+    def add(self, fragment):
+        completed = []
+        while len(self.tool_calls) <= fragment.index:
+            if self.tool_calls:
+                completed.extend(self._complete(len(self.tool_calls) - 1))
+            self.tool_calls.append({"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+        tool_call = self.tool_calls[fragment.index]
+        if fragment.id:
+            tool_call["id"] = fragment.id
+        if fragment.function is not None:
+            if fragment.function.name:
+                tool_call["function"]["name"] += fragment.function.name
+            if fragment.function.arguments:
+                tool_call["function"]["arguments"] += fragment.function.arguments
+                if tool_call["function"]["arguments"].rstrip().endswith("}"):
+                    try:
+                        json.loads(tool_call["function"]["arguments"])
+                    except ValueError:
+                        pass
+                    else:
+                        completed.extend(self._complete(fragment.index))
+        return completed
+
+    def finish(self):
+        completed = []
+        for index in range(len(self.tool_calls)):
+            completed.extend(self._complete(index))
+        return completed
+
+    def _complete(self, index):
+        if index in self._completed:
+            return []
+        self._completed.add(index)
+        return [self.tool_calls[index]]
+
+async def maintain_main_history(session):
+    # Waiting for an overdue summary happens off the event loop so other sessions keep running.
+    if session.main_agent_history.exceeds(session.compactor.limit_tokens):
+        await asyncio.to_thread(session.compactor.maintain)
+    else:
+        session.compactor.maintain()
+
+def build_main_agent_messages(session):
+    return [
+        {"role": "system", "content": system_prompt}
+    ] + [to_api_message(msg) for msg in session.main_agent_history]
+
+async def record_assistant_message(session, content, tool_calls):
+    session.main_agent_history.append({
+        "role": "assistant",
+        "content": content,
+        "tool_calls": tool_calls or None,
+        "timestamp": datetime.now().isoformat()
+    })
+    await maintain_main_history(session)
+
+async def record_tool_results(session, tool_calls, results):
+    for tool_call, result in zip(tool_calls, results):
+        session.main_agent_history.append({
+            "role": "tool",
+            "content": json.dumps(result),
+            "tool_call_id": tool_call["id"],
+            "timestamp": datetime.now().isoformat()
+        })
+        await maintain_main_history(session)
+
+async def start_customer_turn(session, customer_query):
+    session.main_agent_history.append({
         "role": "user",
         "content": customer_query,
         "timestamp": datetime.now().isoformat()
     })
-    token_count = estimate_tokens(main_agent_history + [{"role": "system", "content": system_prompt}])
-    if token_count > CONTEXT_WINDOW_LIMIT * CONTEXT_THRESHOLD:
-        main_agent_history[:] = summarize_chat_history(main_agent_history)
-    messages = [
-        {"role": "system", "content": system_prompt}
-    ] + main_agent_history
+    await maintain_main_history(session)
+
+async def handle_customer_query_async(customer_query, session_id=DEFAULT_SESSION_ID):
+    session = await session_manager.acquire_async(session_id)
+    try:
+        with tracing.span("customer.turn", session_id=session_id, stream=False):
+            return await run_customer_turn(session, customer_query)
+    finally:
+        session_manager.release(session)
+
+async def run_customer_turn(session, customer_query):
+    await start_customer_turn(session, customer_query)
     while True:
-        response = openai.chat.completions.create(
+        response = await llm_backend.chat(
+            messages=build_main_agent_messages(session),
             model="gpt-4o",
-            messages=messages,
             tools=tools,
             tool_choice="auto"
         )
         assistant_message = response.choices[0].message
-        main_agent_history.append({
-            "role": assistant_message.role,
-            "content": assistant_message.content,
-            "tool_calls": assistant_message.tool_calls,
-            "timestamp": datetime.now().isoformat()
-        })
-        token_count = estimate_tokens(main_agent_history + [{"role": "system", "content": system_prompt}])
-        if token_count > CONTEXT_WINDOW_LIMIT * CONTEXT_THRESHOLD:
-            main_agent_history[:] = summarize_chat_history(main_agent_history)
-        if not assistant_message.tool_calls:
+        tool_calls = [tool_call.model_dump() for tool_call in assistant_message.tool_calls or []]
+        await record_assistant_message(session, assistant_message.content, tool_calls)
+        if not tool_calls:
             return assistant_message.content
-        for tool_call in assistant_message.tool_calls:
-            function_name = tool_call.function.name
-            function_args = json.loads(tool_call.function.arguments)
-            if function_name == "todo_write":
-                result = todo_write(function_args["todos"])
-            elif function_name == "todo_read":
-                result = todo_read()
-            elif function_name == "consult_technical_support":
-                result = consult_technical_support(function_args["query"])
-            elif function_name == "consult_billing":
-                result = consult_billing(function_args["query"])
-            else:
-                result = {"error": "Unknown function"}
-            main_agent_history.append({
-                "role": "tool",
-                "content": json.dumps(result),
-                "tool_call_id": tool_call.id,
-                "timestamp": datetime.now().isoformat()
-            })
-            token_count = estimate_tokens(main_agent_history + [{"role": "system", "content": system_prompt}])
-            if token_count > CONTEXT_WINDOW_LIMIT * CONTEXT_THRESHOLD:
-                main_agent_history[:] = summarize_chat_history(main_agent_history)
-            messages.append({
-                "role": "tool",
-                "content": json.dumps(result),
-                "tool_call_id": tool_call.id
-            })
+        results = await dispatch_tool_calls(session, tool_calls)
+        await record_tool_results(session, tool_calls, results)
+
+async def stream_customer_query(customer_query, session_id=DEFAULT_SESSION_ID):
+    session = await session_manager.acquire_async(session_id)
+    try:
+        with tracing.span("customer.turn", session_id=session_id, stream=True):
+            async for delta in stream_customer_turn(session, customer_query):
+                yield delta
+    finally:
+        session_manager.release(session)
+
+async def stream_customer_turn(session, customer_query):
+    # Yields content deltas as they arrive. Tool calls are dispatched while the rest of the
+    # assistant message is still streaming, as soon as each call's arguments are complete.
+    await start_customer_turn(session, customer_query)
+    while True:
+        content_parts = []
+        assembler = ToolCallAssembler()
+        dispatcher = ToolCallDispatcher(session)
+        stream = await llm_backend.chat(
+            messages=build_main_agent_messages(session),
+            model="gpt-4o",
+            tools=tools,
+            tool_choice="auto",
+            stream=True
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content_parts.append(delta.content)
+                yield delta.content
+            for fragment in delta.tool_calls or []:
+                for tool_call in assembler.add(fragment):
+                    dispatcher.submit(tool_call)
+        for tool_call in assembler.finish():
+            dispatcher.submit(tool_call)
+        tool_calls = assembler.tool_calls
+        await record_assistant_message(session, "".join(content_parts) or None, tool_calls)
+        if not tool_calls:
+            return
+        results = await dispatcher.results(tool_calls)
+        await record_tool_results(session, tool_calls, results)
+
+def handle_customer_query(customer_query, session_id=DEFAULT_SESSION_ID):
+    return asyncio.run(handle_customer_query_async(customer_query, session_id))
 
 if __name__ == "__main__":
     queries = [
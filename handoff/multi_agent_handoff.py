@@ -1,24 +1,55 @@
 import os
+import re
+import sys
 import json
-import openai
-from openai import OpenAI
+import math
+import time
+import random
+import asyncio
+import inspect
+import functools
+import contextvars
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# The shared LLM transport lives at the repository root (requires OPENAI_API_KEY environment variable)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tracing
+from llm_transport import CHARS_PER_TOKEN, LLMTimeoutError, default_transport
+
+DEFAULT_TOOL_TIMEOUT_SECONDS = 30
+TOOL_THREAD_WORKERS = 8
+HANDOFF_NOTE_PREFIX = "Handing off to "
+
+# Default per-run limits; pass a RunBudget to run_agent to change them
+DEFAULT_MAX_HOPS = 8
+DEFAULT_MAX_LLM_CALLS = 25
+DEFAULT_MAX_RUN_TOKENS = 200_000
+DEFAULT_RUN_DEADLINE_SECONDS = 120
 
-# Set up the OpenAI client (requires OPENAI_API_KEY environment variable)
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Sync tools run here so a slow tool cannot block the event loop and every other conversation on it
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_THREAD_WORKERS, thread_name_prefix="handoff-tool")
 
 class Agent:
-    def __init__(self, name, instructions, handoff_description=None, tools=None):
+    def __init__(self, name, instructions, handoff_description=None, tools=None, handoffs=None, context_policy=None, max_context_tokens=None):
         self.name = name
         self.instructions = instructions
         self.handoff_description = handoff_description
         self.tools = tools or []
+        self.handoffs = handoffs or []  # Agents this agent may hand the conversation to
+        self.context_policy = context_policy  # What this agent receives on handoff; defaults to run_agent's policy
+        self.max_context_tokens = max_context_tokens  # Prompt budget enforced before each of this agent's LLM calls
+
+def handoff_tool_name(target_agent):
+    """Tool name for handing off to target_agent, restricted to the characters function names allow."""
+    return "handoff_to_" + re.sub(r"[^a-z0-9_-]", "_", target_agent.name.lower())
 
 def create_handoff_tool(target_agent):
     """Create a tool definition for handoff to another agent, including a required reason."""
     return {
         "type": "function",
         "function": {
-            "name": f"handoff_to_{target_agent.name.lower().replace(' ', '_')}",
+            "name": handoff_tool_name(target_agent),
             "description": f"Handoff the query to the {target_agent.name} ({target_agent.handoff_description})",
             "parameters": {
                 "type": "object",
@@ -33,7 +64,497 @@ def create_handoff_tool(target_agent):
         }
     }
 
-async def run_agent(initial_agent, query, tool_functions=None):
+class HandoffGraph:
+    """Registry of agents and the handoffs between them.
+
+    Handoff tool names map straight to agent instances, so resolving a handoff is a dict lookup
+    however many agents are registered, and each agent's full tool list (its own tools plus one
+    handoff tool per target) is built once, when the agent is added. Agents reachable through
+    `handoffs` are registered too. Re-add an agent after changing its tools or handoffs.
+    """
+
+    def __init__(self, agents=()):
+        self.agents = {}
+        self._targets = {}
+        self._tools = {}
+        for agent in agents:
+            self.add_agent(agent)
+
+    def add_agent(self, agent):
+        pending = [agent]
+        while pending:
+            current = pending.pop()
+            registered = self.agents.get(current.name)
+            if registered is not None and registered is not current:
+                raise ValueError(f"Another agent is already registered as {current.name!r}")
+            tool_name = handoff_tool_name(current)
+            claimed = self._targets.get(tool_name)
+            if claimed is not None and claimed is not current:
+                raise ValueError(f"Agents {claimed.name!r} and {current.name!r} share the handoff tool name {tool_name!r}")
+            first_visit = registered is None or current is agent
+            self.agents[current.name] = current
+            self._targets[tool_name] = current
+            if first_visit:
+                self._tools[current.name] = current.tools + [create_handoff_tool(target) for target in current.handoffs]
+                pending.extend(target for target in current.handoffs if target.name not in self.agents)
+
+    def resolve(self, tool_name):
+        """Returns the agent a handoff tool routes to, or None if tool_name is not a handoff."""
+        return self._targets.get(tool_name)
+
+    def tools_for(self, agent):
+        tools = self._tools.get(agent.name)
+        if tools is None:
+            raise ValueError(f"Agent {agent.name!r} is not registered in this handoff graph")
+        return tools
+
+class RouteDecision:
+    """The pre-router's verdict: agent is the specialist to start with, or None to fall back to LLM triage."""
+
+    def __init__(self, agent, confidence, scores, shadow=False):
+        self.agent = agent
+        self.confidence = confidence
+        self.scores = scores
+        self.shadow = shadow  # Confident, but LLM triage still runs so the guess can be checked
+
+class PreRouter:
+    """Routes queries for a triage agent locally, skipping the triage LLM call when confident.
+
+    Each of the triage agent's handoff targets is scored with keyword rules plus a multinomial naive
+    Bayes classifier trained on logged handoff decisions ({"query": ..., "agent": ...} JSON lines).
+    A keyword hit multiplies a target's odds by rule_weight. With no training data and two targets,
+    one hit gives 10/11 confidence, which stays below the default confidence_threshold: a lone
+    keyword is not enough to skip triage, but two agreeing hits (100/101) or a hit the trained
+    classifier agrees with are. Below confidence_threshold the query goes to LLM triage.
+
+    When LLM triage does run, its choice is recorded: it trains the classifier (learn_online), is
+    appended to decision_log, and is compared with the local guess. A shadow_rate share of confident
+    queries still goes through triage so that routing accuracy can be measured; see report().
+    """
+
+    TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+    def __init__(self, triage_agent, rules=None, confidence_threshold=0.95, rule_weight=10.0,
+                 shadow_rate=0.0, learn_online=True, decision_log=None):
+        self.triage_agent = triage_agent
+        self.targets = {agent.name: agent for agent in triage_agent.handoffs}
+        self.rules = {name: [re.compile(pattern, re.IGNORECASE) for pattern in patterns] for name, patterns in (rules or {}).items()}
+        self.confidence_threshold = confidence_threshold
+        self.log_rule_weight = math.log(rule_weight)
+        self.shadow_rate = shadow_rate
+        self.learn_online = learn_online
+        self.decision_log = decision_log
+        self.class_counts = Counter()
+        self.word_counts = {name: Counter() for name in self.targets}
+        self.word_totals = Counter()
+        self.vocabulary = set()
+        self.metrics = {"queries": 0, "skipped": 0, "triaged": 0, "checked": 0, "correct": 0}
+
+    def train(self, examples):
+        """Adds (query, agent name) examples; names that are not handoff targets are ignored."""
+        for query, agent_name in examples:
+            if agent_name not in self.targets:
+                continue
+            words = self.TOKEN_PATTERN.findall(query.lower())
+            self.class_counts[agent_name] += 1
+            self.word_counts[agent_name].update(words)
+            self.word_totals[agent_name] += len(words)
+            self.vocabulary.update(words)
+
+    def train_from_log(self, path):
+        with open(path, encoding="utf-8") as f:
+            self.train((record["query"], record["agent"]) for record in map(json.loads, f) if record)
+
+    def score(self, query):
+        """Returns each target's probability for query."""
+        words = self.TOKEN_PATTERN.findall(query.lower())
+        total = sum(self.class_counts.values())
+        vocabulary_size = len(self.vocabulary) + 1
+        log_scores = {}
+        for name in self.targets:
+            # Laplace smoothing keeps unseen words and untrained targets finite.
+            log_score = math.log((self.class_counts[name] + 1) / (total + len(self.targets)))
+            if total:
+                denominator = self.word_totals[name] + vocabulary_size
+                log_score += sum(math.log((self.word_counts[name][word] + 1) / denominator) for word in words)
+            hits = sum(len(pattern.findall(query)) for pattern in self.rules.get(name, ()))
+            log_scores[name] = log_score + hits * self.log_rule_weight
+        peak = max(log_scores.values())
+        weights = {name: math.exp(log_score - peak) for name, log_score in log_scores.items()}
+        normalizer = sum(weights.values())
+        return {name: weight / normalizer for name, weight in weights.items()}
+
+    def route(self, query):
+        self.metrics["queries"] += 1
+        if not self.targets:
+            return RouteDecision(None, 0.0, {})
+        scores = self.score(query)
+        best = max(scores, key=scores.get)
+        if scores[best] < self.confidence_threshold:
+            return RouteDecision(None, scores[best], scores)
+        if self.shadow_rate and random.random() < self.shadow_rate:
+            return RouteDecision(self.targets[best], scores[best], scores, shadow=True)
+        self.metrics["skipped"] += 1
+        return RouteDecision(self.targets[best], scores[best], scores)
+
+    def observe_triage(self, query, decision, chosen_agent):
+        """Records the handoff LLM triage made for a query the pre-router did not skip."""
+        self.metrics["triaged"] += 1
+        if decision.shadow:
+            self.metrics["checked"] += 1
+            self.metrics["correct"] += decision.agent is chosen_agent
+        if self.learn_online:
+            self.train([(query, chosen_agent.name)])
+        if self.decision_log:
+            with open(self.decision_log, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"query": query, "agent": chosen_agent.name}) + "\n")
+
+    def evaluate(self, examples):
+        """Offline check against labelled (query, agent name) examples, without touching the metrics."""
+        confident = correct = 0
+        examples = list(examples)
+        for query, agent_name in examples:
+            scores = self.score(query)
+            best = max(scores, key=scores.get)
+            if scores[best] >= self.confidence_threshold:
+                confident += 1
+                correct += best == agent_name
+        return {
+            "examples": len(examples),
+            "skip_rate": confident / len(examples) if examples else 0.0,
+            "accuracy": correct / confident if confident else None,
+        }
+
+    def report(self):
+        queries = self.metrics["queries"]
+        checked = self.metrics["checked"]
+        return dict(
+            self.metrics,
+            skip_rate=self.metrics["skipped"] / queries if queries else 0.0,
+            accuracy=self.metrics["correct"] / checked if checked else None,
+        )
+
+def message_field(message, key):
+    # Messages may be dicts or SDK message objects echoed back into the conversation.
+    return message.get(key) if isinstance(message, dict) else getattr(message, key, None)
+
+def message_tokens(message):
+    """Rough prompt size of one message, tool call arguments included."""
+    chars = len(str(message_field(message, "content") or ""))
+    for tool_call in message_field(message, "tool_calls") or ():
+        function = message_field(tool_call, "function")
+        chars += len(message_field(function, "name") or "") + len(message_field(function, "arguments") or "")
+    return chars // CHARS_PER_TOKEN
+
+def split_blocks(messages):
+    """Groups messages into blocks that can be dropped independently: an assistant message with
+    tool calls stays together with its tool responses, which the API requires to follow it."""
+    blocks = []
+    for message in messages:
+        if message_field(message, "role") == "tool" and blocks:
+            blocks[-1].append(message)
+        else:
+            blocks.append([message])
+    return blocks
+
+def is_routing_block(block, graph):
+    """True for handoff chatter: assistant messages that only call handoff tools, and handoff notes."""
+    message = block[0]
+    if message_field(message, "role") != "assistant":
+        return False
+    tool_calls = message_field(message, "tool_calls")
+    if tool_calls:
+        return all(graph.resolve(message_field(message_field(tool_call, "function"), "name")) for tool_call in tool_calls)
+    return str(message_field(message, "content") or "").startswith(HANDOFF_NOTE_PREFIX)
+
+def split_tail(blocks, count):
+    """Splits blocks into (older, recent) with the last count blocks in recent. The latest user turn
+    is moved into recent when it is older, so the request itself is never cut."""
+    start = max(len(blocks) - count, 0)
+    older, recent = blocks[:start], blocks[start:]
+    for index in range(len(older) - 1, -1, -1):
+        if message_field(older[index][0], "role") == "user":
+            return older[:index] + older[index + 1:], [older[index]] + recent
+        if any(message_field(block[0], "role") == "user" for block in recent):
+            break
+    return older, recent
+
+def fit_context(messages, max_tokens):
+    """Drops the oldest blocks after the system prompt until messages fit max_tokens.
+
+    The latest user turn and the final block (the newest tool results) are always kept, so the
+    prompt may stay over budget when those alone exceed it. Returns (messages, blocks dropped).
+    """
+    total = sum(map(message_tokens, messages))
+    if total <= max_tokens:
+        return messages, 0
+    blocks = split_blocks(messages[1:])
+    _, protected = split_tail(blocks, 1)
+    protected = {id(block[0]) for block in protected}
+    kept = []
+    dropped = 0
+    for block in blocks:
+        if total > max_tokens and id(block[0]) not in protected:
+            total -= sum(map(message_tokens, block))
+            dropped += 1
+        else:
+            kept.append(block)
+    return [messages[0]] + [message for block in kept for message in block], dropped
+
+class ContextPolicy:
+    """Decides what part of the conversation an agent receives when it is handed the conversation.
+
+    Earlier routing messages are dropped and select() picks from the remaining message blocks;
+    this hop's handoff notes always follow, under the target agent's system prompt.
+    """
+
+    name = None
+
+    async def select(self, blocks, backend, tracker):
+        """Picks the blocks to hand over; LLM calls go through tracker.chat() so they count against the run's budget."""
+        raise NotImplementedError
+
+    async def build(self, messages, notes, target_agent, graph, backend, tracker):
+        blocks = [block for block in split_blocks(messages[1:]) if not is_routing_block(block, graph)]
+        selected = await self.select(blocks, backend, tracker)
+        return [{"role": "system", "content": target_agent.instructions}] + [message for block in selected for message in block] + notes
+
+class FullContext(ContextPolicy):
+    """Hands over the whole conversation, earlier routing messages included (the default)."""
+
+    name = "full"
+
+    async def build(self, messages, notes, target_agent, graph, backend, tracker):
+        return [{"role": "system", "content": target_agent.instructions}] + messages[1:] + notes
+
+class LastTurnsContext(ContextPolicy):
+    """Hands over the latest user turn and the last count message blocks."""
+
+    name = "last_n"
+
+    def __init__(self, count=6):
+        self.count = count
+
+    async def select(self, blocks, backend, tracker):
+        return split_tail(blocks, self.count)[1]
+
+class UserTurnsContext(ContextPolicy):
+    """Hands over only what the user said."""
+
+    name = "user_only"
+
+    async def select(self, blocks, backend, tracker):
+        return [block for block in blocks if message_field(block[0], "role") == "user"]
+
+class SummarizedContext(ContextPolicy):
+    """Hands over a summary of the older conversation, then the latest user turn and last keep_last blocks verbatim."""
+
+    name = "summarized"
+    SUMMARY_PROMPT = ("Summarize the conversation below for a specialist agent taking it over. Keep the user's goals, "
+                      "facts and numbers they gave, tool results and open questions. Leave out routing between agents.")
+
+    def __init__(self, keep_last=2, model="gpt-4o", max_summary_tokens=300):
+        self.keep_last = keep_last
+        self.model = model
+        self.max_summary_tokens = max_summary_tokens
+
+    async def select(self, blocks, backend, tracker):
+        older, recent = split_tail(blocks, self.keep_last)
+        if not older or (len(older) == 1 and message_field(older[0][0], "role") == "system"):
+            # Nothing new to summarize since the previous hop's summary
+            return older + recent
+        lines = []
+        for message in (message for block in older for message in block):
+            role = message_field(message, "role")
+            if message_field(message, "content"):
+                lines.append(f"{role}: {message_field(message, 'content')}")
+            for tool_call in message_field(message, "tool_calls") or ():
+                function = message_field(tool_call, "function")
+                lines.append(f"{role} called {message_field(function, 'name')}({message_field(function, 'arguments')})")
+        prompt = [
+            {"role": "system", "content": self.SUMMARY_PROMPT},
+            {"role": "user", "content": "\n".join(lines)}
+        ]
+        with tracing.span("handoff.summarize", blocks=len(older)):
+            response = await tracker.chat(
+                backend,
+                messages=prompt,
+                model=self.model,
+                estimated_tokens=sum(map(message_tokens, prompt)) + self.max_summary_tokens,
+                agent_turn=False,
+                max_tokens=self.max_summary_tokens
+            )
+        summary = {"role": "system", "content": f"Summary of the earlier conversation: {response.choices[0].message.content}"}
+        return [[summary]] + recent
+
+class RunBudget:
+    """Limits for one run_agent call. None disables a limit.
+
+    max_handoff_repeats is how many times the same source -> target handoff may recur in a run:
+    with the default of 0, A -> B -> A is allowed (a specialist may send a query back to triage once)
+    but the next A -> B ends the run as a handoff cycle. Longer cycles are caught the same way.
+    """
+
+    def __init__(self, max_hops=DEFAULT_MAX_HOPS, max_llm_calls=DEFAULT_MAX_LLM_CALLS, max_tokens=DEFAULT_MAX_RUN_TOKENS,
+                 deadline_seconds=DEFAULT_RUN_DEADLINE_SECONDS, max_handoff_repeats=0):
+        self.max_hops = max_hops
+        self.max_llm_calls = max_llm_calls
+        self.max_tokens = max_tokens
+        self.deadline_seconds = deadline_seconds
+        self.max_handoff_repeats = max_handoff_repeats
+
+    def start(self, agent):
+        return BudgetTracker(self, agent)
+
+class RunBudgetExceeded(Exception):
+    """Raised inside a run when the next step would exceed its RunBudget; run_agent turns it into a PartialResult."""
+
+    def __init__(self, reason, detail):
+        super().__init__(f"{reason}: {detail}")
+        self.reason = reason
+        self.detail = detail
+
+class BudgetTracker:
+    """Usage of a RunBudget during one run."""
+
+    def __init__(self, budget, agent):
+        self.budget = budget
+        self.started = time.monotonic()
+        self.deadline = self.started + budget.deadline_seconds if budget.deadline_seconds is not None else None
+        self.path = [agent.name]
+        self.handoffs = []  # (source, target) agent names, one per handoff turn
+        self.llm_calls = 0
+        self.tokens = 0
+        self.last_content = None
+
+    @property
+    def hops(self):
+        return len(self.path) - 1
+
+    def remaining_seconds(self):
+        return self.deadline - time.monotonic() if self.deadline is not None else None
+
+    def before_llm_call(self, estimated_tokens=0):
+        """Returns (reason, detail) if the next LLM call would exceed the budget, else None."""
+        if self.budget.max_llm_calls is not None and self.llm_calls >= self.budget.max_llm_calls:
+            return "max_llm_calls", f"{self.llm_calls} LLM calls made"
+        if self.budget.max_tokens is not None and (self.tokens >= self.budget.max_tokens or self.tokens + estimated_tokens > self.budget.max_tokens):
+            return "max_tokens", f"{self.tokens} tokens used, next call needs about {estimated_tokens}" if estimated_tokens else f"{self.tokens} tokens used"
+        if self.deadline is not None and self.remaining_seconds() <= 0:
+            return "deadline", f"{self.budget.deadline_seconds}s deadline passed"
+        return None
+
+    def record_llm_call(self, messages, response, agent_turn=True):
+        self.llm_calls += 1
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.tokens += usage.total_tokens
+        else:
+            self.tokens += sum(map(message_tokens, messages)) + message_tokens(response.choices[0].message)
+        if agent_turn:
+            self.last_content = response.choices[0].message.content or self.last_content
+
+    async def chat(self, backend, messages, model, estimated_tokens=0, agent_turn=True, **kwargs):
+        """Makes an LLM call within the budget, capped at the time left before the deadline.
+
+        Raises RunBudgetExceeded instead of making a call the budget does not allow. agent_turn=False
+        marks calls such as handoff summaries, whose replies are not agent responses.
+        """
+        stop = self.before_llm_call(estimated_tokens)
+        if stop:
+            raise RunBudgetExceeded(*stop)
+        remaining = self.remaining_seconds()
+        if remaining is not None:
+            kwargs["timeout"] = remaining  # The call may not outlive the run's deadline
+        try:
+            response = await backend.chat(messages=messages, model=model, **kwargs)
+        except LLMTimeoutError:
+            if remaining is None or self.remaining_seconds() > 0:
+                raise
+            raise RunBudgetExceeded("deadline", f"{self.budget.deadline_seconds}s deadline passed during an LLM call")
+        self.record_llm_call(messages, response, agent_turn)
+        return response
+
+    def record_handoff(self, source, target):
+        """Records the turn's handoff from source to the agent that takes over, target.
+
+        Returns (reason, detail) if it exhausts the budget or repeats a cycle, else None.
+        """
+        hop = (source.name, target.name)
+        self.path.append(target.name)
+        self.handoffs.append(hop)
+        earlier = [index for index, previous in enumerate(self.handoffs[:-1]) if previous == hop]
+        if len(earlier) > self.budget.max_handoff_repeats:
+            # Report the hops since the previous time this handoff was made
+            return "handoff_cycle", " -> ".join([source.name] + [target_name for _, target_name in self.handoffs[earlier[-1]:]])
+        if self.budget.max_hops is not None and self.hops > self.budget.max_hops:
+            return "max_hops", f"{self.hops} handoffs made"
+        return None
+
+    def partial_result(self, reason, detail, agent):
+        return PartialResult(reason, detail, agent.name, self.last_content, list(self.path), self.llm_calls, self.tokens, time.monotonic() - self.started)
+
+class PartialResult:
+    """What run_agent returns when a RunBudget stops it before an agent gives a final answer.
+
+    content is the last assistant text seen in the run, if any; path lists the agents in handoff order.
+    """
+
+    def __init__(self, reason, detail, agent, content, path, llm_calls, tokens, elapsed_seconds):
+        self.reason = reason
+        self.detail = detail
+        self.agent = agent
+        self.content = content
+        self.path = path
+        self.llm_calls = llm_calls
+        self.tokens = tokens
+        self.elapsed_seconds = elapsed_seconds
+
+    @property
+    def hops(self):
+        return len(self.path) - 1
+
+    def to_dict(self):
+        return {
+            "reason": self.reason,
+            "detail": self.detail,
+            "agent": self.agent,
+            "content": self.content,
+            "path": self.path,
+            "hops": self.hops,
+            "llm_calls": self.llm_calls,
+            "tokens": self.tokens,
+            "elapsed_seconds": round(self.elapsed_seconds, 3),
+        }
+
+    def __str__(self):
+        return f"Run stopped early ({self.reason}: {self.detail}) at {self.agent}. Last response: {self.content or 'none'}"
+
+async def execute_tool(tool_name, function, arguments, timeout, executor, agent_name):
+    """Run one tool call and return its result, or an error string on failure or timeout.
+
+    Coroutine functions are awaited on the event loop; sync functions are sent to executor.
+    With a thread pool the call keeps the caller's context so its spans nest under the run;
+    a process pool needs picklable, module-level functions.
+    """
+    with tracing.span("tool.call", tool=tool_name, agent=agent_name) as tool_span:
+        try:
+            if inspect.iscoroutinefunction(function):
+                return await asyncio.wait_for(function(**arguments), timeout)
+            if isinstance(executor, ThreadPoolExecutor):
+                call = functools.partial(contextvars.copy_context().run, function, **arguments)
+            else:
+                call = functools.partial(function, **arguments)
+            return await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(executor, call), timeout)
+        except asyncio.TimeoutError:
+            # A sync tool keeps running on its worker; only the wait is abandoned.
+            tool_span.set_attribute("error", "timeout")
+            return f"Error executing tool {tool_name}: timed out after {timeout} seconds"
+        except Exception as e:
+            tool_span.set_attribute("error", str(e))
+            return f"Error executing tool {tool_name}: {str(e)}"
+
+async def run_agent(initial_agent, query, tool_functions=None, backend=None, tracer=None, graph=None, tool_timeouts=None, executor=None, pre_router=None, context_policy=None, budget=None):
     """Custom runner implementation for agents with handoff support, structured handoff reasons, and general tool call handling.
     
     This is a simple asynchronous runner that handles agent execution, tool calls (including handoffs with reasons and other general tools),
@@ -41,87 +562,158 @@ async def run_agent(initial_agent, query, tool_functions=None):
     The handoff reason is extracted from the tool call arguments (structured as JSON) and inserted into the conversation history for transparency.
     
     General tools are executed via the provided tool_functions dict (tool_name -> callable), and their results are appended back to the messages.
+    Tools may be sync functions or coroutine functions. All tool calls in one assistant message run concurrently,
+    sync ones on a bounded pool, and their results are appended in the order of the tool calls.
     
     Args:
         initial_agent: The starting Agent instance.
         query: The initial user query.
         tool_functions: Optional dict of tool_name to callable functions for non-handoff tools.
+        backend: Optional llm_transport.LLMBackend; defaults to the shared OpenAI transport.
+        tracer: Optional tracing.Tracer for the run, its LLM calls, handoffs and tool calls;
+            defaults to the process-wide tracer (a no-op unless configured).
+        graph: Optional HandoffGraph containing initial_agent. Build one per deployment and reuse it;
+            without it a graph of the agents reachable from initial_agent is built for this run.
+        tool_timeouts: Optional dict of tool_name to timeout in seconds (default DEFAULT_TOOL_TIMEOUT_SECONDS).
+        executor: Optional executor for sync tools; defaults to the shared tool_executor thread pool.
+        pre_router: Optional PreRouter for initial_agent. When it is confident the run starts at the
+            specialist directly, saving the triage LLM call.
+        context_policy: What an agent receives on handoff when it has no context_policy of its own:
+            FullContext (the default), LastTurnsContext, SummarizedContext or UserTurnsContext. All but
+            FullContext drop earlier routing messages. Agents with max_context_tokens also have their
+            oldest messages dropped before each LLM call to stay within that budget.
+        budget: Optional RunBudget capping handoffs, LLM calls, tokens and wall-clock time, and
+            stopping handoff cycles; defaults to RunBudget().
     
-    Returns the final response from the agent.
+    Returns the final response from the agent, or a PartialResult if the budget ran out first.
+    LLM failures raise an llm_transport.LLMError once the shared transport has exhausted its retries.
     """
     tool_functions = tool_functions or {}
+    backend = backend or default_transport
+    graph = graph or HandoffGraph([initial_agent])
+    tool_timeouts = tool_timeouts or {}
+    executor = executor or tool_executor
+    context_policy = context_policy or FullContext()
+    budget = budget or RunBudget()
+    tracer = tracer or tracing.get_tracer()
+    with tracing.use_tracer(tracer), tracer.span("handoff.run", initial_agent=initial_agent.name) as run_span:
+        decision = None
+        if pre_router is not None and pre_router.triage_agent is initial_agent:
+            decision = pre_router.route(query)
+            run_span.set_attributes({"prerouted": decision.agent is not None and not decision.shadow, "preroute_confidence": round(decision.confidence, 4)})
+            if decision.agent is not None and not decision.shadow:
+                initial_agent = decision.agent
+        tracker = budget.start(initial_agent)
+        result = await _run_agent_loop(initial_agent, query, tool_functions, backend, graph, tool_timeouts, executor, run_span, context_policy, tracker, pre_router, decision)
+        run_span.set_attributes({"hops": tracker.hops, "llm_calls": tracker.llm_calls, "tokens": tracker.tokens})
+        if isinstance(result, PartialResult):
+            run_span.set_attributes({"stop_reason": result.reason, "stop_detail": result.detail})
+        return result
+
+async def _run_agent_loop(initial_agent, query, tool_functions, backend, graph, tool_timeouts, executor, run_span, context_policy, tracker, pre_router=None, decision=None):
+    """The agent loop behind run_agent, recorded under run_span; returns a PartialResult when tracker's budget runs out."""
     current_agent = initial_agent
     messages = [
         {"role": "system", "content": current_agent.instructions},
         {"role": "user", "content": query}
     ]
     
+    run_span.set_attribute("final_agent", current_agent.name)
+    dropped_blocks = 0
     while True:
-        response = await client.chat.completions.create(
-            model="gpt-4o",  # Or any model you prefer, e.g., "gpt-3.5-turbo"
-            messages=messages,
-            tools=current_agent.tools or None,
-            tool_choice="auto" if current_agent.tools else None
-        )
+        if current_agent.max_context_tokens:
+            messages, dropped = fit_context(messages, current_agent.max_context_tokens)
+            if dropped:
+                dropped_blocks += dropped
+                run_span.set_attribute("context_blocks_dropped", dropped_blocks)
+        tools = graph.tools_for(current_agent)
+        tool_args = {"tools": tools, "tool_choice": "auto"} if tools else {}
+        try:
+            response = await tracker.chat(
+                backend,
+                messages=messages,
+                model="gpt-4o",  # Or any model you prefer, e.g., "gpt-3.5-turbo"
+                **tool_args
+            )
+        except RunBudgetExceeded as e:
+            return tracker.partial_result(e.reason, e.detail, current_agent)
         
         choice = response.choices[0]
         if choice.finish_reason == "tool_calls":
             tool_calls = choice.message.tool_calls
             messages.append(choice.message)  # Add assistant's message with tool calls
             
-            for tool_call in tool_calls:
+            issuing_agent = current_agent
+            results = [None] * len(tool_calls)
+            running = {}
+            handoff_notes = []
+            for index, tool_call in enumerate(tool_calls):
                 tool_name = tool_call.function.name
                 # Parse the structured arguments (JSON)
                 arguments = json.loads(tool_call.function.arguments)
                 
-                if tool_name.startswith("handoff_to_"):
+                target_agent = graph.resolve(tool_name)
+                if target_agent is not None:
                     # Handle handoff tools specially
-                    target_name = tool_name.replace("handoff_to_", "").replace("_", " ").title()
                     reason = arguments.get("reason", "No reason provided")
                     
-                    # Switch to the target agent (in a real setup, map names to agents)
-                    if target_name == "History Tutor":
-                        current_agent = history_tutor_agent
-                    elif target_name == "Math Tutor":
-                        current_agent = math_tutor_agent
-                    else:
-                        raise ValueError(f"Unknown handoff target: {target_name}")
-                    
-                    # Insert the handoff reason into the conversation history as an assistant message
-                    messages.append({
-                        "role": "assistant",
-                        "content": f"Handing off to {current_agent.name}. Reason: {reason}"
-                    })
+                    # Switch to the target agent
+                    with tracing.span("handoff", source=current_agent.name, target=target_agent.name, reason=reason):
+                        current_agent = target_agent
+                    run_span.set_attribute("final_agent", current_agent.name)
+                    handoff_notes.append(f"{HANDOFF_NOTE_PREFIX}{current_agent.name}. Reason: {reason}")
                     
-                    # Append a tool response to confirm handoff (required for the API loop)
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "name": tool_name,
-                        "content": "Handoff successful."
-                    })
-                    
-                    # Update system prompt for the new agent
-                    messages[0] = {"role": "system", "content": current_agent.instructions}
+                    # A tool response confirms the handoff (required for the API loop)
+                    results[index] = "Handoff successful."
+                
+                elif tool_name.startswith("handoff_to_"):
+                    raise ValueError(f"Unknown handoff target: {tool_name}")
                 
                 else:
                     # Handle general (non-handoff) tools
                     if tool_name not in tool_functions:
                         raise ValueError(f"Unknown tool: {tool_name}. No function provided.")
                     
-                    # Execute the tool function with the arguments
+                    # Start the tool now; calls from the same message are independent and run concurrently
+                    running[index] = asyncio.ensure_future(execute_tool(
+                        tool_name, tool_functions[tool_name], arguments,
+                        tool_timeouts.get(tool_name, DEFAULT_TOOL_TIMEOUT_SECONDS), executor, issuing_agent.name
+                    ))
+            
+            for index, result in zip(running, await asyncio.gather(*running.values())):
+                results[index] = result
+            
+            # Append the tool results back to messages, in tool call order
+            for tool_call, result in zip(tool_calls, results):
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": tool_call.id,
+                    "name": tool_call.function.name,
+                    "content": str(result)
+                })
+            
+            if handoff_notes:
+                # Several handoffs in one message count as one hop, to the agent that ends up current
+                stop = tracker.record_handoff(issuing_agent, current_agent)
+                if decision is not None and issuing_agent is pre_router.triage_agent:
+                    pre_router.observe_triage(query, decision, current_agent)
+                if stop:
+                    # The tools of this turn have finished; stop before building context (and possibly
+                    # summarizing) for an agent that will never run
+                    return tracker.partial_result(*stop, current_agent)
+                
+                # The handoff reasons go in as assistant messages after the tool responses, since the API
+                # expects those right after the tool calls. The new agent's policy then picks what it sees
+                # of the conversation, under its own system prompt.
+                notes = [{"role": "assistant", "content": note} for note in handoff_notes]
+                policy = current_agent.context_policy or context_policy
+                with tracing.span("handoff.context", agent=current_agent.name, policy=policy.name) as context_span:
+                    tokens_before = sum(map(message_tokens, messages))
                     try:
-                        result = tool_functions[tool_name](**arguments)
-                    except Exception as e:
-                        result = f"Error executing tool {tool_name}: {str(e)}"
-                    
-                    # Append the tool result back to messages
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "name": tool_name,
-                        "content": str(result)
-                    })
+                        messages = await policy.build(messages, notes, current_agent, graph, backend, tracker)
+                    except RunBudgetExceeded as e:
+                        return tracker.partial_result(e.reason, e.detail, current_agent)
+                    context_span.set_attributes({"tokens_before": tokens_before, "tokens_after": sum(map(message_tokens, messages))})
             
             # Continue the loop after handling tools
             continue
@@ -133,23 +725,24 @@ async def run_agent(initial_agent, query, tool_functions=None):
 history_tutor_agent = Agent(
     name="History Tutor",
     handoff_description="Specialist agent for historical questions",
-    instructions="You provide assistance with historical queries. Explain important events and context clearly."
+    instructions="You provide assistance with historical queries. Explain important events and context clearly.",
+    context_policy=UserTurnsContext(),  # The routing turn carries nothing a specialist needs
+    max_context_tokens=8000
 )
 
 math_tutor_agent = Agent(
     name="Math Tutor",
     handoff_description="Specialist agent for math questions",
-    instructions="You provide help with math problems. Explain your reasoning at each step and include examples."
+    instructions="You provide help with math problems. Explain your reasoning at each step and include examples.",
+    context_policy=UserTurnsContext(),
+    max_context_tokens=8000
 )
 
-# Triage agent with handoff tools (now requiring reasons)
+# Triage agent with handoff tools (now requiring reasons); the graph generates them from its handoffs
 triage_agent = Agent(
     name="Triage Agent",
     instructions="You determine which agent to use based on the user's homework question. Use the handoff tools to route to the appropriate specialist, and always provide a reason in the tool call.",
-    tools=[
-        create_handoff_tool(history_tutor_agent),
-        create_handoff_tool(math_tutor_agent)
-    ]
+    handoffs=[history_tutor_agent, math_tutor_agent]
 )
 
 # Example: Add a general tool to the Math Tutor for demonstration
@@ -177,16 +770,34 @@ math_tutor_agent.tools = [{
     }
 }]
 
-# Example usage with tool_functions
-import asyncio
+# Built after the Math Tutor's tools are set, since the graph precomputes each agent's tool list
+homework_graph = HandoffGraph([triage_agent])
 
+# Keyword rules for skipping LLM triage on clear-cut homework questions
+HOMEWORK_ROUTING_RULES = {
+    "Math Tutor": [
+        r"\b(?:solve|equation|square root|sqrt|integral|derivative|algebra|geometry|fraction|percent(?:age)?|multiply|divide|calculate|plus|minus|times)\b",
+        # "-" is left out: digit-hyphen-digit is far more often a year range ("1914-1918") than a subtraction
+        r"\d+\s*[+*/^]\s*\d+",
+    ],
+    "History Tutor": [
+        r"\b(?:war|empire|century|revolution|dynasty|ancient|medieval|treaty|monarch|king|queen|battle|civilization|president)s?\b",
+    ],
+}
+
+homework_pre_router = PreRouter(triage_agent, rules=HOMEWORK_ROUTING_RULES)
+
+# Example usage with tool_functions
 async def main():
     query = "What is the square root of 16?"  # This should handoff to Math Tutor and use the calculate tool
     tool_functions = {
         "calculate_expression": calculate_expression
     }
-    result = await run_agent(triage_agent, query, tool_functions=tool_functions)
+    result = await run_agent(triage_agent, query, tool_functions=tool_functions, graph=homework_graph, pre_router=homework_pre_router)
     print(result)
+    if isinstance(result, PartialResult):
+        print(f"Run budget: {result.to_dict()}")
+    print(f"Pre-router: {homework_pre_router.report()}")
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,569 @@
+"""Shared LLM transport used by the customer service agent, the handoff demo and Magentic.
+
+One long-lived OpenAI client per process keeps HTTP connections pooled. Every call gets a
+deadline, transient failures (timeouts, dropped connections, 429 and 5xx) are retried with
+jittered exponential backoff, and a circuit breaker fails fast while the API is down.
+Failures surface as LLMError subclasses instead of strings that could leak into a conversation.
+
+Callers talk to an LLMBackend. LLMTransport is the OpenAI one; ScriptedBackend answers offline
+from a script so orchestration overhead can be measured without a network.
+"""
+import asyncio
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from types import SimpleNamespace
+
+import httpx
+import openai
+
+import tracing
+
+CHARS_PER_TOKEN = 4
+DEFAULT_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+DEFAULT_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+DEFAULT_COMPLETION_TOKENS = 1000  # Reserved against the token quota when a call sets no max_tokens
+RETRY_BASE_SECONDS = 0.5
+RETRY_MAX_SECONDS = 30.0
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30.0
+RATE_LIMIT_WINDOW_SECONDS = 60.0
+
+
+class LLMError(Exception):
+    """Base class for failed LLM calls. retryable marks failures worth another attempt."""
+
+    retryable = False
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class LLMTimeoutError(LLMError):
+    retryable = True
+
+
+class LLMConnectionError(LLMError):
+    retryable = True
+
+
+class LLMRateLimitError(LLMError):
+    retryable = True
+
+
+class LLMServerError(LLMError):
+    retryable = True
+
+
+class LLMRequestError(LLMError):
+    """The API rejected the request itself (bad arguments, auth, context length)."""
+
+
+class CircuitOpenError(LLMError):
+    """Raised without calling the API while the circuit breaker is open."""
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def classify_error(error):
+    """Maps an OpenAI or httpx exception onto the LLMError hierarchy."""
+    if isinstance(error, LLMError):
+        return error
+    if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException, openai.APITimeoutError)):
+        return LLMTimeoutError(f"LLM call timed out: {error}")
+    if isinstance(error, (httpx.TransportError, openai.APIConnectionError)):
+        return LLMConnectionError(f"LLM connection failed: {error}")
+    status = getattr(error, "status_code", None)
+    if status == 429:
+        return LLMRateLimitError(f"LLM rate limited: {error}", status, _retry_after(error))
+    if status is not None and status >= 500:
+        return LLMServerError(f"LLM server error {status}: {error}", status, _retry_after(error))
+    return LLMRequestError(f"LLM request failed: {error}", status)
+
+
+def estimate_request_tokens(messages, max_tokens=None):
+    # Messages may be dicts or SDK message objects echoed back into the conversation.
+    contents = (message.get("content") if isinstance(message, dict) else getattr(message, "content", None) for message in messages)
+    prompt_chars = sum(len(str(content)) for content in contents if content)
+    return prompt_chars // CHARS_PER_TOKEN + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures; after reset_seconds one trial call is let through."""
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+    def before_call(self):
+        """Raises CircuitOpenError while open; returns True when the caller holds the half-open trial."""
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            if time.monotonic() - self.opened_at < self.reset_seconds or self._trial_in_flight:
+                raise CircuitOpenError("LLM circuit breaker is open; the API has been failing")
+            self._trial_in_flight = True
+            return True
+
+    def release_trial(self):
+        # The trial call was abandoned (cancelled) before it could tell us anything about the API.
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self._trial_in_flight or self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class RateLimiter:
+    """Sliding one-minute window over request and token reservations, shared by every caller.
+
+    State is guarded by a thread lock and never held while waiting, so the same limiter
+    serves worker threads and any number of event loops.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._reservations = deque()
+        self._reserved_tokens = 0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, requests_per_minute=None, tokens_per_minute=None):
+        with self._lock:
+            self.requests_per_minute = requests_per_minute
+            self.tokens_per_minute = tokens_per_minute
+
+    def _try_reserve(self, tokens):
+        # Returns (reservation, 0) on success, or (None, seconds to wait).
+        with self._lock:
+            now = time.monotonic()
+            while self._reservations and now - self._reservations[0][0] >= RATE_LIMIT_WINDOW_SECONDS:
+                self._reserved_tokens -= self._reservations.popleft()[1]
+            if now < self._paused_until:
+                return None, self._paused_until - now
+            over_requests = self.requests_per_minute is not None and len(self._reservations) >= self.requests_per_minute
+            over_tokens = self.tokens_per_minute is not None and self._reservations and self._reserved_tokens + tokens > self.tokens_per_minute
+            if over_requests or over_tokens:
+                return None, RATE_LIMIT_WINDOW_SECONDS - (now - self._reservations[0][0])
+            reservation = [now, tokens]
+            self._reservations.append(reservation)
+            self._reserved_tokens += tokens
+            return reservation, 0.0
+
+    async def acquire(self, tokens):
+        while True:
+            reservation, wait = self._try_reserve(tokens)
+            if reservation is not None:
+                return reservation
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, tokens):
+        while True:
+            reservation, wait = self._try_reserve(tokens)
+            if reservation is not None:
+                return reservation
+            time.sleep(wait)
+
+    def settle(self, reservation, tokens):
+        # Swaps the up-front estimate for the usage the API reported.
+        with self._lock:
+            if reservation in self._reservations:
+                self._reserved_tokens += tokens - reservation[1]
+            reservation[1] = tokens
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def _limit_from_env(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def _record_usage(span, response):
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        span.set_attributes({"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens})
+
+
+class LLMBackend:
+    """Interface for chat completion providers.
+
+    chat() is awaited from event loops and chat_sync() is called from worker threads. Both take
+    chat-completions arguments and return objects shaped like the OpenAI SDK's responses; with
+    stream=True, chat() returns an async iterator of chunks. Both record an "llm.call" span;
+    providers implement _chat() and _chat_sync().
+    """
+
+    async def chat(self, messages, model, timeout=None, **kwargs):
+        with tracing.span("llm.call", model=model, backend=type(self).__name__, messages=len(messages), stream=bool(kwargs.get("stream"))) as span:
+            response = await self._chat(messages, model, timeout, **kwargs)
+            _record_usage(span, response)
+            return response
+
+    def chat_sync(self, messages, model, timeout=None, **kwargs):
+        with tracing.span("llm.call", model=model, backend=type(self).__name__, messages=len(messages), stream=bool(kwargs.get("stream"))) as span:
+            response = self._chat_sync(messages, model, timeout, **kwargs)
+            _record_usage(span, response)
+            return response
+
+    async def _chat(self, messages, model, timeout=None, **kwargs):
+        raise NotImplementedError
+
+    def _chat_sync(self, messages, model, timeout=None, **kwargs):
+        raise NotImplementedError
+
+
+class LLMTransport(LLMBackend):
+    """Chat completions over pooled clients, with deadlines, retries, rate limiting and a breaker."""
+
+    def __init__(self, api_key=None, base_url=None, timeout=DEFAULT_TIMEOUT_SECONDS, max_retries=DEFAULT_MAX_RETRIES,
+                 rate_limiter=None, circuit_breaker=None, max_connections=MAX_CONNECTIONS):
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.base_url = base_url or os.getenv("OPENAI_BASE_URL")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS)
+        self._sync_client = None
+        # httpx async pools are bound to the event loop that opened them; a long-running service
+        # has one loop and therefore one client, while asyncio.run() callers get one per loop.
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._client_lock = threading.Lock()
+
+    def _client(self):
+        with self._client_lock:
+            if self._sync_client is None:
+                self._sync_client = openai.OpenAI(
+                    api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                    http_client=httpx.Client(limits=self.limits)
+                )
+            return self._sync_client
+
+    def _async_client(self):
+        loop = asyncio.get_running_loop()
+        with self._client_lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = openai.AsyncOpenAI(
+                    api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                    http_client=httpx.AsyncClient(limits=self.limits)
+                )
+                self._async_clients[loop] = client
+            return client
+
+    def _next_delay(self, error, attempt, deadline):
+        # Returns how long to wait before retrying, or None when the error should be raised.
+        if not error.retryable or attempt >= self.max_retries:
+            return None
+        delay = error.retry_after
+        if delay is None:
+            delay = min(RETRY_BASE_SECONDS * 2 ** attempt, RETRY_MAX_SECONDS) * random.uniform(0.5, 1.0)
+        if time.monotonic() + delay >= deadline:
+            return None
+        if isinstance(error, LLMRateLimitError):
+            # Hold back every caller sharing the quota, not just this one.
+            self.rate_limiter.pause(delay)
+        return delay
+
+    def _record_failure(self, error, trial):
+        # A rejected request still means the API is reachable, so only transient errors count.
+        # 429s are quota pressure, not an outage; the rate limiter pause already backs everyone off.
+        if isinstance(error, LLMRateLimitError):
+            if trial:
+                self.circuit_breaker.release_trial()
+        elif error.retryable:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+
+    def _record(self, reservation, response):
+        self.circuit_breaker.record_success()
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.rate_limiter.settle(reservation, usage.total_tokens)
+
+    async def _chat(self, messages, model, timeout=None, **kwargs):
+        # With stream=True the stream is returned once it opens; only opening it is retried.
+        deadline = time.monotonic() + (timeout or self.timeout)
+        tokens = estimate_request_tokens(messages, kwargs.get("max_tokens"))
+        attempt = 0
+        # The breaker gates new calls only; retries of a call it let through run until the deadline.
+        trial = self.circuit_breaker.before_call()
+        while True:
+            try:
+                reservation = await self.rate_limiter.acquire(tokens)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise LLMTimeoutError("LLM call deadline passed while waiting for rate limit capacity")
+                response = await asyncio.wait_for(
+                    self._async_client().chat.completions.create(model=model, messages=messages, timeout=remaining, **kwargs),
+                    remaining
+                )
+            except Exception as e:
+                error = classify_error(e)
+                self._record_failure(error, trial)
+                trial = False
+                delay = self._next_delay(error, attempt, deadline)
+                if delay is None:
+                    raise error from e
+                attempt += 1
+                tracing.current_span().set_attributes({"retries": attempt, "last_error": type(error).__name__})
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancellation (a sibling prompt failed, the caller timed out) is not an API failure,
+                # but a half-open trial slot must still be handed back or the breaker never closes.
+                if trial:
+                    self.circuit_breaker.release_trial()
+                raise
+            self._record(reservation, response)
+            return response
+
+    def _chat_sync(self, messages, model, timeout=None, **kwargs):
+        deadline = time.monotonic() + (timeout or self.timeout)
+        tokens = estimate_request_tokens(messages, kwargs.get("max_tokens"))
+        attempt = 0
+        # The breaker gates new calls only; retries of a call it let through run until the deadline.
+        trial = self.circuit_breaker.before_call()
+        while True:
+            try:
+                reservation = self.rate_limiter.acquire_sync(tokens)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise LLMTimeoutError("LLM call deadline passed while waiting for rate limit capacity")
+                response = self._client().chat.completions.create(model=model, messages=messages, timeout=remaining, **kwargs)
+            except Exception as e:
+                error = classify_error(e)
+                self._record_failure(error, trial)
+                trial = False
+                delay = self._next_delay(error, attempt, deadline)
+                if delay is None:
+                    raise error from e
+                attempt += 1
+                tracing.current_span().set_attributes({"retries": attempt, "last_error": type(error).__name__})
+                time.sleep(delay)
+                continue
+            except BaseException:
+                if trial:
+                    self.circuit_breaker.release_trial()
+                raise
+            self._record(reservation, response)
+            return response
+
+
+default_transport = LLMTransport(
+    rate_limiter=RateLimiter(_limit_from_env("OPENAI_REQUESTS_PER_MINUTE"), _limit_from_env("OPENAI_TOKENS_PER_MINUTE"))
+)
+
+
+class RateLimitedBackend(LLMBackend):
+    """Applies an extra RateLimiter to another backend's calls, on top of any limits it has itself.
+
+    Use it to give one workload (e.g. a batch run) its own quota without reconfiguring the
+    limiter of a backend that other callers share. The wrapped backend is called through its
+    public chat()/chat_sync(), so its own "llm.call" span nests under this one.
+    """
+
+    def __init__(self, backend, rate_limiter):
+        self.backend = backend
+        self.rate_limiter = rate_limiter
+
+    def _settle(self, reservation, response):
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.rate_limiter.settle(reservation, usage.total_tokens)
+
+    async def _chat(self, messages, model, timeout=None, **kwargs):
+        reservation = await self.rate_limiter.acquire(estimate_request_tokens(messages, kwargs.get("max_tokens")))
+        try:
+            response = await self.backend.chat(messages, model, timeout, **kwargs)
+        except LLMRateLimitError as e:
+            self.rate_limiter.pause(e.retry_after or RETRY_BASE_SECONDS)
+            raise
+        self._settle(reservation, response)
+        return response
+
+    def _chat_sync(self, messages, model, timeout=None, **kwargs):
+        reservation = self.rate_limiter.acquire_sync(estimate_request_tokens(messages, kwargs.get("max_tokens")))
+        try:
+            response = self.backend.chat_sync(messages, model, timeout, **kwargs)
+        except LLMRateLimitError as e:
+            self.rate_limiter.pause(e.retry_after or RETRY_BASE_SECONDS)
+            raise
+        self._settle(reservation, response)
+        return response
+
+
+class ScriptedRecord(SimpleNamespace):
+    """Attribute access like the SDK's response models, including model_dump()."""
+
+    def model_dump(self):
+        def dump(value):
+            if isinstance(value, ScriptedRecord):
+                return value.model_dump()
+            if isinstance(value, list):
+                return [dump(item) for item in value]
+            return value
+        return {key: dump(value) for key, value in vars(self).items()}
+
+
+class ScriptedBackend(LLMBackend):
+    """Offline backend that answers from a script with simulated latency and token counts.
+
+    responses is a list of replies used in turn (cycling), or a callable
+    responder(messages, model, kwargs) returning a reply. A reply is either the assistant's text
+    or a dict with "content" and/or "tool_calls" ([{"name": ..., "arguments": {...}}]).
+    Each call waits latency_seconds before its first token, then completion tokens are
+    produced at tokens_per_second (instant when None).
+    """
+
+    def __init__(self, responses=None, latency_seconds=0.0, tokens_per_second=None, stream_chunk_chars=16):
+        self.responses = responses
+        self.latency_seconds = latency_seconds
+        self.tokens_per_second = tokens_per_second
+        self.stream_chunk_chars = stream_chunk_chars
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def _reply(self, messages, model, kwargs):
+        call_number = next(self._counter)
+        if callable(self.responses):
+            reply = self.responses(messages, model, kwargs)
+        elif self.responses:
+            reply = self.responses[call_number % len(self.responses)]
+        else:
+            reply = f"Scripted reply {call_number + 1} from {model}."
+        if isinstance(reply, str):
+            reply = {"content": reply}
+        tool_calls = [
+            ScriptedRecord(
+                id=f"call_{call_number}_{index}",
+                type="function",
+                function=ScriptedRecord(
+                    name=tool_call["name"],
+                    arguments=tool_call["arguments"] if isinstance(tool_call.get("arguments"), str) else json.dumps(tool_call.get("arguments", {}))
+                )
+            )
+            for index, tool_call in enumerate(reply.get("tool_calls") or [])
+        ]
+        message = ScriptedRecord(role="assistant", content=reply.get("content"), tool_calls=tool_calls or None)
+        output_chars = len(message.content or "") + sum(len(call.function.name) + len(call.function.arguments) for call in tool_calls)
+        usage = ScriptedRecord(
+            prompt_tokens=estimate_request_tokens(messages, max_tokens=1) - 1,
+            completion_tokens=max(1, output_chars // CHARS_PER_TOKEN)
+        )
+        usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += usage.prompt_tokens
+            self.completion_tokens += usage.completion_tokens
+        return call_number, message, usage
+
+    def _generation_seconds(self, usage):
+        return usage.completion_tokens / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    @staticmethod
+    def _response(call_number, model, message, usage):
+        return ScriptedRecord(
+            id=f"chatcmpl-scripted-{call_number}",
+            object="chat.completion",
+            model=model,
+            choices=[ScriptedRecord(index=0, message=message, finish_reason="tool_calls" if message.tool_calls else "stop")],
+            usage=usage
+        )
+
+    def _chunks(self, message, usage):
+        def chunk(content=None, tool_calls=None, finish_reason=None):
+            delta = ScriptedRecord(role="assistant", content=content, tool_calls=tool_calls)
+            return ScriptedRecord(object="chat.completion.chunk", choices=[ScriptedRecord(index=0, delta=delta, finish_reason=finish_reason)])
+
+        size = self.stream_chunk_chars
+        content = message.content or ""
+        for start in range(0, len(content), size):
+            yield chunk(content=content[start:start + size])
+        for index, tool_call in enumerate(message.tool_calls or []):
+            yield chunk(tool_calls=[ScriptedRecord(index=index, id=tool_call.id, type="function", function=ScriptedRecord(name=tool_call.function.name, arguments=""))])
+            arguments = tool_call.function.arguments
+            for start in range(0, len(arguments), size):
+                yield chunk(tool_calls=[ScriptedRecord(index=index, id=None, type=None, function=ScriptedRecord(name=None, arguments=arguments[start:start + size]))])
+        final = chunk(finish_reason="tool_calls" if message.tool_calls else "stop")
+        final.usage = usage
+        yield final
+
+    async def _stream(self, message, usage):
+        chunks = list(self._chunks(message, usage))
+        delay = self._generation_seconds(usage) / len(chunks)
+        for chunk in chunks:
+            if delay:
+                await asyncio.sleep(delay)
+            yield chunk
+
+    def _stream_sync(self, message, usage):
+        chunks = list(self._chunks(message, usage))
+        delay = self._generation_seconds(usage) / len(chunks)
+        for chunk in chunks:
+            time.sleep(delay)
+            yield chunk
+
+    async def _chat(self, messages, model, timeout=None, **kwargs):
+        call_number, message, usage = self._reply(messages, model, kwargs)
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        if kwargs.get("stream"):
+            return self._stream(message, usage)
+        generation_seconds = self._generation_seconds(usage)
+        if generation_seconds:
+            await asyncio.sleep(generation_seconds)
+        return self._response(call_number, model, message, usage)
+
+    def _chat_sync(self, messages, model, timeout=None, **kwargs):
+        call_number, message, usage = self._reply(messages, model, kwargs)
+        time.sleep(self.latency_seconds)
+        if kwargs.get("stream"):
+            return self._stream_sync(message, usage)
+        time.sleep(self._generation_seconds(usage))
+        return self._response(call_number, model, message, usage)
@@ -1,27 +1,36 @@
 import os
-import openai
+import sys
+import re
 import json
-from typing import List, Dict
+import time
+import zlib
+import random
+import hashlib
+from collections import deque
+from typing import AsyncIterator, Callable, Iterable, List, Dict, Optional, Tuple
 import asyncio
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tracing
+from llm_transport import CHARS_PER_TOKEN, LLMBackend, RateLimitedBackend, RateLimiter, default_transport
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+LLM_MAX_TOKENS = 1000
 
 
-async def call_llm(prompt: str, system_message: str = "You are a helpful assistant.", model: str = "gpt-4") -> str:
-    try:
-        response = await openai.ChatCompletion.acreate(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=1000,
-            temperature=0.7
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"Error in LLM call: {str(e)}"
+async def call_llm(prompt: str, system_message: str = "You are a helpful assistant.", model: str = "gpt-4", response_format: Optional[Dict[str, str]] = None, backend: Optional[LLMBackend] = None) -> str:
+    # Failures raise LLMError subclasses after the transport's retries, so they never reach the chat history.
+    extra_args = {"response_format": response_format} if response_format else {}
+    response = await (backend or default_transport).chat(
+        [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": prompt}
+        ],
+        model,
+        max_tokens=LLM_MAX_TOKENS,
+        temperature=0.7,
+        **extra_args
+    )
+    return response.choices[0].message.content
 
 
 ORCHESTRATOR_TASK_LEDGER_FACTS_PROMPT = """Below I will present you a request.
@@ -140,6 +149,34 @@ DO NOT OUTPUT ANYTHING OTHER THAN JSON, AND DO NOT DEVIATE FROM THIS SCHEMA:
 }
 """
 
+ORCHESTRATOR_PROGRESS_LEDGER_PARALLEL_PROMPT = """
+If several team members can work on independent parts of the plan at the same time (no one needs another's output
+for their step), you may add one more key to the JSON object:
+
+    "parallel_steps": [
+        {
+            "speaker": string,
+            "instruction": string
+        }
+    ]
+
+List at most {{$max_parallel}} steps, each for a different team member (select from: {{$names}}). Only use
+"parallel_steps" when the steps are truly independent; otherwise omit the key and rely on "next_speaker".
+"""
+
+ORCHESTRATOR_PROGRESS_LEDGER_REPAIR_PROMPT = """Your previous answer could not be used as a progress ledger:
+
+{{$error}}
+
+Here is your previous answer:
+
+{{$response}}
+
+Reply with ONLY the corrected JSON object. It must have the keys "is_request_satisfied", "is_in_loop",
+"is_progress_being_made", "next_speaker" and "instruction_or_question", each an object with a "reason" string and
+an "answer". The first three answers are booleans, "next_speaker" must be one of: {{$names}}.
+"""
+
 ORCHESTRATOR_TASK_LEDGER_FACTS_UPDATE_PROMPT = """As a reminder, we are working to solve the following task:
 
 {{$task}}
@@ -179,19 +216,72 @@ The answer should be phrased as if you were speaking to the user.
 """
 
 
+AGENT_RESPONSE_PROMPT = """
+        You are {{$name}}, {{$description}}.
+        Task: {{$task}}
+        Current plan: {{$plan}}
+        Instruction: {{$instruction}}
+        Chat history: {{$history}}
+        Provide a concise response to advance the task.
+        """
+
+
+class PromptTemplate:
+    PLACEHOLDER = re.compile(r"\{\{\$(\w+)\}\}")
+
+    def __init__(self, text: str):
+        # Split once into literal parts and placeholder names; render is a single join.
+        self.parts: List[str] = []
+        self.names: List[str] = []
+        position = 0
+        for match in self.PLACEHOLDER.finditer(text):
+            self.parts.append(text[position:match.start()])
+            self.names.append(match.group(1))
+            position = match.end()
+        self.parts.append(text[position:])
+
+    def render(self, **values: str) -> str:
+        pieces = [self.parts[0]]
+        for name, part in zip(self.names, self.parts[1:]):
+            pieces.append(values[name])
+            pieces.append(part)
+        return "".join(pieces)
+
+
+TASK_LEDGER_FACTS_TEMPLATE = PromptTemplate(ORCHESTRATOR_TASK_LEDGER_FACTS_PROMPT)
+TASK_LEDGER_PLAN_TEMPLATE = PromptTemplate(ORCHESTRATOR_TASK_LEDGER_PLAN_PROMPT)
+TASK_LEDGER_FULL_TEMPLATE = PromptTemplate(ORCHESTRATOR_TASK_LEDGER_FULL_PROMPT)
+PROGRESS_LEDGER_TEMPLATE = PromptTemplate(ORCHESTRATOR_PROGRESS_LEDGER_PROMPT)
+PROGRESS_LEDGER_PARALLEL_TEMPLATE = PromptTemplate(ORCHESTRATOR_PROGRESS_LEDGER_PARALLEL_PROMPT)
+TASK_LEDGER_FACTS_UPDATE_TEMPLATE = PromptTemplate(ORCHESTRATOR_TASK_LEDGER_FACTS_UPDATE_PROMPT)
+TASK_LEDGER_PLAN_UPDATE_TEMPLATE = PromptTemplate(ORCHESTRATOR_TASK_LEDGER_PLAN_UPDATE_PROMPT)
+PROGRESS_LEDGER_REPAIR_TEMPLATE = PromptTemplate(ORCHESTRATOR_PROGRESS_LEDGER_REPAIR_PROMPT)
+FINAL_ANSWER_TEMPLATE = PromptTemplate(ORCHESTRATOR_FINAL_ANSWER_PROMPT)
+AGENT_RESPONSE_TEMPLATE = PromptTemplate(AGENT_RESPONSE_PROMPT)
+
+
 class MagenticContext:
-    def __init__(self, task: str, participant_descriptions: Dict[str, str]):
+    def __init__(self, task: str, participant_descriptions: Dict[str, str], backend: Optional[LLMBackend] = None):
         self.task = task
         self.participant_descriptions = participant_descriptions
+        self.backend = backend
+        self.team_str = json.dumps(participant_descriptions, indent=2)
+        self.names = ", ".join(participant_descriptions.keys())
         self.chat_history: List[Dict[str, str]] = []
         self.round_count = 0
         self.stall_count = 0
         self.reset_count = 0
         self.facts = ""
         self.plan = ""
+        self._serialized_messages: List[str] = []
+        self._message_tokens: List[int] = []
+        self._history_json: Optional[str] = None
 
     def reset(self):
         self.chat_history = []
+        self._serialized_messages = []
+        self._message_tokens = []
+        self._history_json = None
         self.stall_count = 0
         self.reset_count += 1
 
@@ -200,126 +290,351 @@ class MagenticContext:
         if name:
             message["name"] = name
         self.chat_history.append(message)
+        # Each message is serialized once, when it is added.
+        serialized = json.dumps(message, separators=(",", ":"))
+        self._serialized_messages.append(serialized)
+        self._message_tokens.append(len(serialized) // CHARS_PER_TOKEN + 1)
+        self._history_json = None
+
+    def history_json(self) -> str:
+        if self._history_json is None:
+            self._history_json = "[" + ",".join(self._serialized_messages) + "]"
+        return self._history_json
+
+    def render_history(self, max_tokens: Optional[int] = None) -> str:
+        # Compact JSON of the newest messages that fit in max_tokens (estimated at CHARS_PER_TOKEN).
+        if max_tokens is None:
+            return self.history_json()
+        start = len(self._serialized_messages)
+        used = 0
+        while start > 0 and used + self._message_tokens[start - 1] <= max_tokens:
+            start -= 1
+            used += self._message_tokens[start]
+        if start == 0:
+            return self.history_json()
+        return "[" + ",".join(self._serialized_messages[start:]) + "]"
 
 
 class ProgressLedger:
-    def __init__(self, is_request_satisfied: bool, is_in_loop: bool, is_progress_being_made: bool, next_speaker: str, instruction_or_question: str):
+    def __init__(self, is_request_satisfied: bool, is_in_loop: bool, is_progress_being_made: bool, next_speaker: str, instruction_or_question: str, parallel_steps: List[Dict[str, str]] = None):
         self.is_request_satisfied = is_request_satisfied
         self.is_in_loop = is_in_loop
         self.is_progress_being_made = is_progress_being_made
         self.next_speaker = next_speaker
         self.instruction_or_question = instruction_or_question
+        self.parallel_steps = parallel_steps or []
+
+
+class LedgerParseError(ValueError):
+    pass
+
+
+JSON_FENCE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+LEDGER_BOOLEAN_KEYS = ("is_request_satisfied", "is_in_loop", "is_progress_being_made")
+LEDGER_STRING_KEYS = ("next_speaker", "instruction_or_question")
+
+
+def extract_json_object(text: str) -> dict:
+    # Accepts a bare object, an object inside a ``` fence, or an object surrounded by other text.
+    fenced = JSON_FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    start = text.find("{")
+    if start == -1:
+        raise LedgerParseError("no JSON object found")
+    try:
+        data, _ = json.JSONDecoder().raw_decode(text, start)
+    except json.JSONDecodeError as e:
+        raise LedgerParseError(f"invalid JSON: {e}")
+    if not isinstance(data, dict):
+        raise LedgerParseError("top-level JSON value is not an object")
+    return data
+
+
+def ledger_answer(ledger_data: dict, key: str):
+    if key not in ledger_data:
+        raise LedgerParseError(f"missing key {key!r}")
+    value = ledger_data[key]
+    return value.get("answer") if isinstance(value, dict) else value
+
+
+def parse_progress_ledger(text: str, participants: List[str]) -> ProgressLedger:
+    ledger_data = extract_json_object(text)
+    answers = {}
+    for key in LEDGER_BOOLEAN_KEYS:
+        answer = ledger_answer(ledger_data, key)
+        if isinstance(answer, str) and answer.strip().lower() in ("true", "false"):
+            answer = answer.strip().lower() == "true"
+        if not isinstance(answer, bool):
+            raise LedgerParseError(f"{key} answer must be a boolean")
+        answers[key] = answer
+    for key in LEDGER_STRING_KEYS:
+        answer = ledger_answer(ledger_data, key)
+        if not isinstance(answer, str) or not answer:
+            raise LedgerParseError(f"{key} answer must be a non-empty string")
+        answers[key] = answer
+    if not answers["is_request_satisfied"] and answers["next_speaker"] not in participants:
+        raise LedgerParseError(f"next_speaker {answers['next_speaker']!r} is not one of {participants}")
+    parallel_steps = ledger_data.get("parallel_steps")
+    return ProgressLedger(
+        answers["is_request_satisfied"],
+        answers["is_in_loop"],
+        answers["is_progress_being_made"],
+        answers["next_speaker"],
+        answers["instruction_or_question"],
+        parallel_steps if isinstance(parallel_steps, list) else None
+    )
 
 
 class Agent:
-    def __init__(self, name: str, description: str):
+    def __init__(self, name: str, description: str, history_token_budget: Optional[int] = None):
         self.name = name
         self.description = description
+        self.history_token_budget = history_token_budget
+
+    async def respond(self, context: MagenticContext, instruction: str = None) -> str:
+        if instruction is None:
+            instruction = context.chat_history[-1]['content'] if context.chat_history else 'Provide your input.'
+        prompt = AGENT_RESPONSE_TEMPLATE.render(
+            name=self.name,
+            description=self.description,
+            task=context.task,
+            plan=context.plan,
+            instruction=instruction,
+            history=context.render_history(self.history_token_budget)
+        )
+        with tracing.span("agent.respond", agent=self.name, prompt_chars=len(prompt)):
+            return await call_llm(prompt, system_message=f"You are {self.name}, an expert {self.description}.", backend=context.backend)
 
-    async def respond(self, context: MagenticContext) -> str:
-        prompt = f"""
-        You are {self.name}, {self.description}.
-        Task: {context.task}
-        Current plan: {context.plan}
-        Instruction: {context.chat_history[-1]['content'] if context.chat_history else 'Provide your input.'}
-        Chat history: {json.dumps(context.chat_history, indent=2)}
-        Provide a concise response to advance the task.
-        """
-        return await call_llm(prompt, system_message=f"You are {self.name}, an expert {self.description}.")
+
+class LedgerPrompt:
+    def __init__(self, key: str, build: Callable[[Dict[str, str]], str], depends_on: List[str] = None, system_message: str = "You are a helpful assistant."):
+        self.key = key
+        self.build = build
+        self.depends_on = depends_on or []
+        self.system_message = system_message
+
+
+async def run_ledger_prompts(prompts: List[LedgerPrompt], backend: Optional[LLMBackend] = None) -> Dict[str, str]:
+    # Prompts must be listed after the prompts they depend on. Each one starts as soon as its
+    # dependencies have answered, so independent prompts run concurrently.
+    tasks: Dict[str, asyncio.Future] = {}
+
+    async def run_prompt(prompt: LedgerPrompt) -> str:
+        inputs = {key: await tasks[key] for key in prompt.depends_on}
+        return await call_llm(prompt.build(inputs), system_message=prompt.system_message, backend=backend)
+
+    for prompt in prompts:
+        missing = [key for key in prompt.depends_on if key not in tasks]
+        if missing:
+            raise ValueError(f"Ledger prompt {prompt.key} depends on unknown or later prompts: {missing}")
+        tasks[prompt.key] = asyncio.ensure_future(run_prompt(prompt))
+    try:
+        results = await asyncio.gather(*tasks.values())
+    except BaseException:
+        # A failed prompt fails the ledger; do not leave its siblings running.
+        for task in tasks.values():
+            task.cancel()
+        raise
+    return dict(zip(tasks.keys(), results))
+
+
+class TaskLedgerCache:
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.entries: Dict[str, Dict[str, str]] = {}
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(task: str, participant_descriptions: Dict[str, str]) -> str:
+        payload = json.dumps([task, participant_descriptions], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, task: str, participant_descriptions: Dict[str, str]) -> Optional[Dict[str, str]]:
+        return self.entries.get(self.key(task, participant_descriptions))
+
+    def put(self, task: str, participant_descriptions: Dict[str, str], facts: str, plan: str):
+        self.entries[self.key(task, participant_descriptions)] = {"facts": facts, "plan": plan}
+        if self.path:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+
+
+class LoopDetector:
+    MERSENNE_PRIME = (1 << 61) - 1
+
+    def __init__(self, similarity_threshold: float = 0.8, window: int = 6, min_repeats: int = 2, num_perm: int = 32, shingle_size: int = 3):
+        self.similarity_threshold = similarity_threshold
+        self.min_repeats = min_repeats
+        self.shingle_size = shingle_size
+        rng = random.Random(0)
+        self._hash_params = [(rng.randrange(1, self.MERSENNE_PRIME), rng.randrange(self.MERSENNE_PRIME)) for _ in range(num_perm)]
+        self._steps: deque = deque(maxlen=window)
+        self._looping = False
+
+    def signature(self, text: str) -> Tuple[int, ...]:
+        # MinHash over word shingles; the share of equal slots estimates Jaccard similarity.
+        words = text.lower().split()
+        shingles = {" ".join(words[i:i + self.shingle_size]) for i in range(max(len(words) - self.shingle_size + 1, 1))}
+        hashes = [zlib.crc32(shingle.encode()) for shingle in shingles]
+        return tuple(min((a * h + b) % self.MERSENNE_PRIME for h in hashes) for a, b in self._hash_params)
+
+    @staticmethod
+    def similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+        return sum(x == y for x, y in zip(a, b)) / len(a)
+
+    def observe(self, speaker: str, instruction: str, response: str):
+        step = (speaker, self.signature(instruction), self.signature(response))
+        repeats = sum(
+            1 for previous in self._steps
+            if previous[0] == speaker
+            and self.similarity(previous[1], step[1]) >= self.similarity_threshold
+            and self.similarity(previous[2], step[2]) >= self.similarity_threshold
+        )
+        self._steps.append(step)
+        self._looping = repeats >= self.min_repeats
+
+    def is_looping(self) -> bool:
+        return self._looping
+
+    def clear(self):
+        self._steps.clear()
+        self._looping = False
 
 
 class MagenticManager:
-    def __init__(self, max_stall_count: int = 3, max_round_count: int = 10, max_reset_count: int = None):
+    def __init__(self, max_stall_count: int = 3, max_round_count: int = 10, max_reset_count: int = None, max_parallel_speakers: int = 1, task_ledger_cache: TaskLedgerCache = None, ledger_model: str = "gpt-4o", loop_similarity_threshold: Optional[float] = 0.8, loop_window: int = 6, loop_min_repeats: int = 2, max_skipped_ledgers: int = 1, ledger_skip_streak: int = 2):
         self.max_stall_count = max_stall_count
         self.max_round_count = max_round_count
         self.max_reset_count = max_reset_count
+        self.max_parallel_speakers = max_parallel_speakers
+        self.task_ledger_cache = task_ledger_cache if task_ledger_cache is not None else TaskLedgerCache()
+        self.ledger_model = ledger_model
+        self.ledger_metrics = {"parsed": 0, "repaired": 0, "parse_failures": 0, "fallbacks": 0}
+        self.loop_similarity_threshold = loop_similarity_threshold
+        self.loop_window = loop_window
+        self.loop_min_repeats = loop_min_repeats
+        self.max_skipped_ledgers = max_skipped_ledgers
+        self.ledger_skip_streak = ledger_skip_streak
+
+    def create_loop_detector(self) -> Optional[LoopDetector]:
+        if self.loop_similarity_threshold is None:
+            return None
+        return LoopDetector(self.loop_similarity_threshold, self.loop_window, self.loop_min_repeats)
 
     async def plan(self, context: MagenticContext) -> str:
-        facts_prompt = ORCHESTRATOR_TASK_LEDGER_FACTS_PROMPT.replace("{{$task}}", context.task)
-        context.facts = await call_llm(facts_prompt)
-        team_str = json.dumps(context.participant_descriptions, indent=2)
-        plan_prompt = ORCHESTRATOR_TASK_LEDGER_PLAN_PROMPT.replace("{{$team}}", team_str)
-        context.plan = await call_llm(plan_prompt)
-        return ORCHESTRATOR_TASK_LEDGER_FULL_PROMPT.replace(
-            "{{$task}}", context.task
-        ).replace(
-            "{{$team}}", team_str
-        ).replace(
-            "{{$facts}}", context.facts
-        ).replace(
-            "{{$plan}}", context.plan
-        )
+        cached = self.task_ledger_cache.get(context.task, context.participant_descriptions)
+        tracing.current_span().set_attribute("task_ledger_cache_hit", cached is not None)
+        if cached is not None:
+            context.facts = cached["facts"]
+            context.plan = cached["plan"]
+            return self._format_task_ledger(context)
+        # The plan prompt does not include the facts, so both ledger prompts run concurrently.
+        results = await run_ledger_prompts([
+            LedgerPrompt("facts", lambda inputs: TASK_LEDGER_FACTS_TEMPLATE.render(task=context.task)),
+            LedgerPrompt("plan", lambda inputs: TASK_LEDGER_PLAN_TEMPLATE.render(team=context.team_str))
+        ], context.backend)
+        context.facts = results["facts"]
+        context.plan = results["plan"]
+        self.task_ledger_cache.put(context.task, context.participant_descriptions, context.facts, context.plan)
+        return self._format_task_ledger(context)
 
     async def replan(self, context: MagenticContext) -> str:
-        facts_prompt = ORCHESTRATOR_TASK_LEDGER_FACTS_UPDATE_PROMPT.replace(
-            "{{$task}}", context.task
-        ).replace(
-            "{{$old_facts}}", context.facts
-        )
-        context.facts = await call_llm(facts_prompt)
-        team_str = json.dumps(context.participant_descriptions, indent=2)
-        plan_prompt = ORCHESTRATOR_TASK_LEDGER_PLAN_UPDATE_PROMPT.replace("{{$team}}", team_str)
-        context.plan = await call_llm(plan_prompt)
-        return ORCHESTRATOR_TASK_LEDGER_FULL_PROMPT.replace(
-            "{{$task}}", context.task
-        ).replace(
-            "{{$team}}", team_str
-        ).replace(
-            "{{$facts}}", context.facts
-        ).replace(
-            "{{$plan}}", context.plan
-        )
+        results = await run_ledger_prompts([
+            LedgerPrompt("facts", lambda inputs: TASK_LEDGER_FACTS_UPDATE_TEMPLATE.render(task=context.task, old_facts=context.facts)),
+            LedgerPrompt("plan", lambda inputs: TASK_LEDGER_PLAN_UPDATE_TEMPLATE.render(team=context.team_str))
+        ], context.backend)
+        context.facts = results["facts"]
+        context.plan = results["plan"]
+        return self._format_task_ledger(context)
+
+    def _format_task_ledger(self, context: MagenticContext) -> str:
+        return TASK_LEDGER_FULL_TEMPLATE.render(task=context.task, team=context.team_str, facts=context.facts, plan=context.plan)
 
     async def create_progress_ledger(self, context: MagenticContext) -> ProgressLedger:
-        team_str = json.dumps(context.participant_descriptions, indent=2)
-        names = ", ".join(context.participant_descriptions.keys())
-        prompt = ORCHESTRATOR_PROGRESS_LEDGER_PROMPT.replace(
-            "{{$task}}", context.task
-        ).replace(
-            "{{$team}}", team_str
-        ).replace(
-            "{{$names}}", names
-        ).replace(
-            "{{$facts}}", context.facts
-        ).replace(
-            "{{$plan}}", context.plan
+        prompt = PROGRESS_LEDGER_TEMPLATE.render(
+            task=context.task, team=context.team_str, names=context.names, facts=context.facts, plan=context.plan
+        )
+        if self.max_parallel_speakers > 1:
+            prompt += PROGRESS_LEDGER_PARALLEL_TEMPLATE.render(max_parallel=str(self.max_parallel_speakers), names=context.names)
+        participants = list(context.participant_descriptions.keys())
+        response = await call_llm(
+            prompt,
+            system_message="You are a task manager analyzing progress.",
+            model=self.ledger_model,
+            response_format={"type": "json_object"},
+            backend=context.backend
         )
-        response = await call_llm(prompt, system_message="You are a task manager analyzing progress.")
         try:
-            ledger_data = json.loads(response)
-            return ProgressLedger(
-                ledger_data["is_request_satisfied"]["answer"],
-                ledger_data["is_in_loop"]["answer"],
-                ledger_data["is_progress_being_made"]["answer"],
-                ledger_data["next_speaker"]["answer"],
-                ledger_data["instruction_or_question"]["answer"]
-            )
-        except Exception as e:
-            print(f"Error parsing progress ledger: {e}")
+            progress = self._parse_ledger(response, participants, "initial")
+            self.ledger_metrics["parsed"] += 1
+            return progress
+        except LedgerParseError as e:
+            self.ledger_metrics["parse_failures"] += 1
+            print(f"Error parsing progress ledger: {e}. Asking for a corrected ledger.")
+            error = e
+        # One targeted re-ask with just the parse error and the bad answer, not the full ledger prompt.
+        repair_prompt = PROGRESS_LEDGER_REPAIR_TEMPLATE.render(error=str(error), response=response, names=context.names)
+        response = await call_llm(
+            repair_prompt,
+            system_message="You are a task manager analyzing progress.",
+            model=self.ledger_model,
+            response_format={"type": "json_object"},
+            backend=context.backend
+        )
+        try:
+            progress = self._parse_ledger(response, participants, "repair")
+            self.ledger_metrics["repaired"] += 1
+            return progress
+        except LedgerParseError as e:
+            self.ledger_metrics["parse_failures"] += 1
+            self.ledger_metrics["fallbacks"] += 1
+            print(f"Error parsing repaired progress ledger: {e}")
             return ProgressLedger(
-                False, False, True, 
-                list(context.participant_descriptions.keys())[0], 
+                False, False, True,
+                participants[0],
                 "Continue with the next step."
             )
 
+    def _parse_ledger(self, response: str, participants: List[str], stage: str) -> ProgressLedger:
+        with tracing.span("ledger.parse", stage=stage, response_chars=len(response)):
+            return parse_progress_ledger(response, participants)
+
     async def prepare_final_answer(self, context: MagenticContext) -> str:
-        prompt = ORCHESTRATOR_FINAL_ANSWER_PROMPT.replace("{{$task}}", context.task)
-        return await call_llm(prompt)
+        prompt = FINAL_ANSWER_TEMPLATE.render(task=context.task)
+        return await call_llm(prompt, backend=context.backend)
 
 
 class MagenticOrchestration:
-    def __init__(self, agents: List[Agent], manager: MagenticManager):
+    def __init__(self, agents: List[Agent], manager: MagenticManager, backend: Optional[LLMBackend] = None, tracer: Optional[tracing.Tracer] = None):
         self.agents = {agent.name: agent for agent in agents}
         self.manager = manager
+        self.backend = backend
+        self.tracer = tracer
 
     async def run(self, task: str):
-        context = MagenticContext(task, {agent.name: agent.description for agent in self.agents.values()})
-        
+        context = MagenticContext(task, {agent.name: agent.description for agent in self.agents.values()}, self.backend)
+        tracer = self.tracer or tracing.get_tracer()
+        with tracing.use_tracer(tracer), tracer.span("magentic.run", agents=len(self.agents)) as span:
+            try:
+                return await self._run(context)
+            finally:
+                span.set_attributes({"rounds": context.round_count, "resets": context.reset_count})
+
+    async def _run(self, context: MagenticContext):
         # Initial planning
-        task_ledger = await self.manager.plan(context)
+        with tracing.span("ledger.plan"):
+            task_ledger = await self.manager.plan(context)
         context.add_message("assistant", task_ledger, "Manager")
         print(f"Initial Task Ledger:\n{task_ledger}\n")
 
+        loop_detector = self.manager.create_loop_detector()
+        recent_ledgers: List[ProgressLedger] = []
+        skipped_ledgers = 0
         is_completed = False
         while context.round_count < self.manager.max_round_count and not is_completed:
             # Check reset limit
@@ -334,9 +649,29 @@ class MagenticOrchestration:
 
             context.round_count += 1
 
-            # Evaluate progress
-            progress = await self.manager.create_progress_ledger(context)
-            print(f"Progress Ledger: {json.dumps(vars(progress), indent=2)}")
+            # Replan straight away when recent steps repeat earlier ones, without asking the LLM
+            if loop_detector is not None and loop_detector.is_looping():
+                print("Repeated instructions and responses detected. Replanning...")
+                with tracing.span("ledger.replan", reason="loop_detected"):
+                    task_ledger = await self.manager.replan(context)
+                context.reset()
+                loop_detector.clear()
+                recent_ledgers.clear()
+                context.add_message("assistant", task_ledger, "Manager")
+                print(f"Updated Task Ledger:\n{task_ledger}\n")
+                continue
+
+            # Evaluate progress, unless the next step is unambiguous
+            if self._can_skip_ledger(context, recent_ledgers, skipped_ledgers):
+                skipped_ledgers += 1
+                progress = ProgressLedger(False, False, True, recent_ledgers[-1].next_speaker, "Continue with the next step of the plan.")
+                print(f"Skipping progress ledger: {progress.next_speaker} is clearly next.")
+            else:
+                skipped_ledgers = 0
+                with tracing.span("ledger.progress", round=context.round_count):
+                    progress = await self.manager.create_progress_ledger(context)
+                recent_ledgers = (recent_ledgers + [progress])[-self.manager.ledger_skip_streak:]
+                print(f"Progress Ledger: {json.dumps(vars(progress), indent=2)}")
 
             # Check for completion
             if progress.is_request_satisfied:
@@ -350,7 +685,8 @@ class MagenticOrchestration:
                 context.stall_count += 1
                 if context.stall_count > self.manager.max_stall_count:
                     print("Stalling detected. Replanning...")
-                    task_ledger = await self.manager.replan(context)
+                    with tracing.span("ledger.replan", reason="stalled"):
+                        task_ledger = await self.manager.replan(context)
                     context.reset()
                     context.add_message("assistant", task_ledger, "Manager")
                     print(f"Updated Task Ledger:\n{task_ledger}\n")
@@ -358,6 +694,12 @@ class MagenticOrchestration:
                 else:
                     print("Progress stalled, but continuing...")
 
+            # Fan out to several speakers when the ledger marked their steps as independent
+            parallel_steps = self._select_parallel_steps(progress)
+            if len(parallel_steps) > 1:
+                await self._run_parallel_steps(context, parallel_steps, loop_detector)
+                continue
+
             # Request next speaker
             next_speaker = progress.next_speaker
             if next_speaker not in self.agents:
@@ -369,6 +711,8 @@ class MagenticOrchestration:
             response = await self.agents[next_speaker].respond(context)
             context.add_message("user", response, next_speaker)
             print(f"{next_speaker}: {response}\n")
+            if loop_detector is not None:
+                loop_detector.observe(next_speaker, progress.instruction_or_question, response)
 
         print("Max rounds reached." if not is_completed else "Task completed.")
         partial_result = next(
@@ -378,6 +722,116 @@ class MagenticOrchestration:
         print(f"Partial Result:\n{partial_result}")
         return partial_result
 
+    def _can_skip_ledger(self, context: MagenticContext, recent_ledgers: List[ProgressLedger], skipped_ledgers: int) -> bool:
+        # The next speaker is unambiguous with a single agent, or when the last ledger_skip_streak
+        # ledgers all picked the same speaker while reporting progress and no loop. Skips are capped
+        # at max_skipped_ledgers in a row and never used in the last round, so a real ledger still
+        # checks for completion at least every max_skipped_ledgers + 1 rounds and before giving up.
+        if skipped_ledgers >= self.manager.max_skipped_ledgers or context.round_count >= self.manager.max_round_count:
+            return False
+        streak = recent_ledgers if len(self.agents) > 1 else recent_ledgers[-1:]
+        if not streak or len(streak) < min(self.manager.ledger_skip_streak, len(self.agents)):
+            return False
+        return all(
+            ledger.next_speaker == streak[-1].next_speaker
+            and ledger.is_progress_being_made
+            and not ledger.is_in_loop
+            and not ledger.parallel_steps
+            for ledger in streak
+        )
+
+    def _select_parallel_steps(self, progress: ProgressLedger) -> List[Dict[str, str]]:
+        if self.manager.max_parallel_speakers <= 1:
+            return []
+        steps = []
+        speakers = set()
+        for step in progress.parallel_steps:
+            if not isinstance(step, dict):
+                continue
+            speaker = step.get("speaker")
+            if speaker not in self.agents or speaker in speakers or not step.get("instruction"):
+                print(f"Skipping parallel step for unknown or repeated speaker {speaker}")
+                continue
+            speakers.add(speaker)
+            steps.append({"speaker": speaker, "instruction": step["instruction"]})
+        return steps[:self.manager.max_parallel_speakers]
+
+    async def _run_parallel_steps(self, context: MagenticContext, steps: List[Dict[str, str]], loop_detector: Optional[LoopDetector] = None):
+        # Every speaker sees the same history snapshot; results are merged in ledger order.
+        semaphore = asyncio.Semaphore(self.manager.max_parallel_speakers)
+
+        async def run_step(step: Dict[str, str]) -> str:
+            async with semaphore:
+                return await self.agents[step["speaker"]].respond(context, step["instruction"])
+
+        responses = await asyncio.gather(*(run_step(step) for step in steps))
+        for step, response in zip(steps, responses):
+            context.add_message("assistant", step["instruction"], "Manager")
+            context.add_message("user", response, step["speaker"])
+            print(f"Manager -> {step['speaker']}: {step['instruction']}")
+            print(f"{step['speaker']}: {response}\n")
+            if loop_detector is not None:
+                loop_detector.observe(step["speaker"], step["instruction"], response)
+
+
+class BatchResult:
+    def __init__(self, index: int, task: str, result: Optional[str] = None, error: Optional[str] = None, elapsed_seconds: float = 0.0):
+        self.index = index
+        self.task = task
+        self.result = result
+        self.error = error
+        self.elapsed_seconds = elapsed_seconds
+
+
+class BatchRunner:
+    def __init__(self, orchestration: MagenticOrchestration, max_concurrency: int = 8, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None, rate_limiter: Optional[RateLimiter] = None):
+        self.max_concurrency = max_concurrency
+        if rate_limiter is None and (requests_per_minute is not None or tokens_per_minute is not None):
+            rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.rate_limiter = rate_limiter
+        if rate_limiter is not None:
+            # Every LLM call of the batch goes through one limiter, wrapped around the backend the
+            # orchestration actually uses; the backend's own limits (and other callers') are left alone.
+            backend = RateLimitedBackend(orchestration.backend or default_transport, rate_limiter)
+            orchestration = MagenticOrchestration(list(orchestration.agents.values()), orchestration.manager, backend, orchestration.tracer)
+        self.orchestration = orchestration
+
+    async def _run_task(self, index: int, task: str) -> BatchResult:
+        started = time.monotonic()
+        try:
+            result = await self.orchestration.run(task)
+            return BatchResult(index, task, result=result, elapsed_seconds=time.monotonic() - started)
+        except Exception as e:
+            return BatchResult(index, task, error=str(e), elapsed_seconds=time.monotonic() - started)
+
+    async def run(self, tasks: Iterable[str]) -> AsyncIterator[BatchResult]:
+        # Workers pull from the shared iterator, so only max_concurrency tasks are ever in flight
+        # and results are yielded in completion order, not input order.
+        pending_tasks = enumerate(tasks)
+        results: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        async def worker():
+            try:
+                for index, task in pending_tasks:
+                    await results.put(await self._run_task(index, task))
+            finally:
+                await results.put(done)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.max_concurrency)]
+        running = len(workers)
+        try:
+            while running:
+                item = await results.get()
+                if item is done:
+                    running -= 1
+                    continue
+                yield item
+        finally:
+            for worker_task in workers:
+                worker_task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
 
 async def main():
     agents = [
@@ -385,11 +839,30 @@ async def main():
         Agent("Strategist", "expert in creating marketing strategies"),
         Agent("Writer", "expert in crafting marketing content")
     ]
-    manager = MagenticManager(max_stall_count=3, max_round_count=10, max_reset_count=3)
+    manager = MagenticManager(max_stall_count=3, max_round_count=10, max_reset_count=3, max_parallel_speakers=2)
     orchestration = MagenticOrchestration(agents, manager)
     
     task = "Plan a marketing campaign for a new eco-friendly product."
     await orchestration.run(task)
 
+
+async def main_batch(tasks_path: str):
+    agents = [
+        Agent("Analyst", "expert in market research and data analysis"),
+        Agent("Strategist", "expert in creating marketing strategies"),
+        Agent("Writer", "expert in crafting marketing content")
+    ]
+    manager = MagenticManager(max_stall_count=3, max_round_count=10, max_reset_count=3, max_parallel_speakers=2)
+    runner = BatchRunner(MagenticOrchestration(agents, manager), max_concurrency=16)
+
+    with open(tasks_path, encoding="utf-8") as f:
+        tasks = (line.strip() for line in f if line.strip())
+        async for item in runner.run(tasks):
+            status = "error" if item.error else "done"
+            print(f"[{item.index}] {status} in {item.elapsed_seconds:.1f}s: {item.error or item.result}")
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if len(sys.argv) > 1:
+        asyncio.run(main_batch(sys.argv[1]))
+    else:
+        asyncio.run(main())
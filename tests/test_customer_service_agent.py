@@ -0,0 +1,93 @@
+import os
+import sys
+import asyncio
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("httpx")
+pytest.importorskip("tiktoken")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import customer_service_agent as cs
+from llm_transport import ScriptedBackend
+
+
+@pytest.fixture
+def scripted_backend(monkeypatch):
+    backend = ScriptedBackend(latency_seconds=0.01)
+    monkeypatch.setattr(cs, "llm_backend", backend)
+    return backend
+
+
+def test_sessions_are_not_evicted_during_a_turn(tmp_path, monkeypatch, scripted_backend):
+    # Far more concurrent turns than max_active: sessions picked for eviction between lookup
+    # and the start of their turn used to be spilled with their pre-turn state.
+    manager = cs.SessionManager(spill_dir=str(tmp_path), max_active=2)
+    monkeypatch.setattr(cs, "session_manager", manager)
+
+    async def run():
+        await asyncio.gather(*(cs.handle_customer_query_async(f"Question {i}", f"customer-{i}") for i in range(20)))
+
+    asyncio.run(run())
+    assert all(session.active_turns == 0 for session in manager._sessions.values())
+    manager.idle_seconds = 0
+    manager.evict_idle()
+    manager.wait_for_spills()
+    assert len(manager) == 0
+
+    reloaded = cs.SessionManager(spill_dir=str(tmp_path))
+    for i in range(20):
+        messages = reloaded.get(f"customer-{i}").main_agent_history.messages
+        assert [message["role"] for message in messages] == ["user", "assistant"]
+        assert messages[0]["content"] == f"Question {i}"
+
+
+def test_session_ids_that_sanitise_alike_get_separate_files(tmp_path):
+    manager = cs.SessionManager(spill_dir=str(tmp_path))
+    for session_id in ("a/b", "a_b", "a b"):
+        manager.get(session_id).main_agent_history.append({"role": "user", "content": session_id})
+    manager.idle_seconds = 0
+    manager.evict_idle()
+    manager.wait_for_spills()
+
+    reloaded = cs.SessionManager(spill_dir=str(tmp_path))
+    for session_id in ("a/b", "a_b", "a b"):
+        assert reloaded.get(session_id).main_agent_history.messages == [{"role": "user", "content": session_id}]
+
+
+def tool_turn(i):
+    return [
+        {"role": "user", "content": f"Question {i} " + "detail " * 20},
+        {"role": "assistant", "content": None, "tool_calls": [
+            {"id": f"call-{i}-{j}", "type": "function", "function": {"name": "list_todos", "arguments": "{}"}} for j in range(2)
+        ]},
+        {"role": "tool", "tool_call_id": f"call-{i}-0", "content": "result " * 30},
+        {"role": "tool", "tool_call_id": f"call-{i}-1", "content": "result " * 30},
+        {"role": "assistant", "content": f"Answer {i} " + "detail " * 20}
+    ]
+
+
+def assert_tool_replies_follow_their_calls(messages):
+    open_calls = set()
+    for message in messages:
+        if message["role"] == "tool":
+            assert message["tool_call_id"] in open_calls
+            open_calls.remove(message["tool_call_id"])
+        else:
+            assert not open_calls
+            open_calls = {call["id"] for call in message.get("tool_calls") or []}
+
+
+def test_compaction_never_separates_tool_replies_from_their_call(scripted_backend):
+    history = cs.TokenTrackedHistory()
+    compactor = cs.HistoryCompactor(history, watermark_tokens=300, limit_tokens=600, tail_tokens=150)
+    for i in range(12):
+        for message in tool_turn(i):
+            history.append(message)
+            compactor.maintain()
+            assert_tool_replies_follow_their_calls([m for m in history.messages if "summary_tier" not in m])
+    compactor.flush()
+    assert any("summary_tier" in message for message in history.messages)
+    assert history.messages[-1]["content"].startswith("Answer 11")
+    assert_tool_replies_follow_their_calls([m for m in history.messages if "summary_tier" not in m])
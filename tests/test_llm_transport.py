@@ -0,0 +1,159 @@
+import os
+import sys
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("httpx")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llm_transport import CircuitBreaker, CircuitOpenError, LLMBackend, LLMTransport, RateLimitedBackend, RateLimiter, ScriptedBackend
+
+
+class HangingTransport(LLMTransport):
+    """A transport whose API calls never return until cancelled."""
+
+    def __init__(self, circuit_breaker):
+        super().__init__(api_key="test", circuit_breaker=circuit_breaker)
+        self.started = 0
+
+    def _async_client(self):
+        async def create(**kwargs):
+            self.started += 1
+            await asyncio.Event().wait()
+
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.headers = {"retry-after": "0.01"}
+
+
+class FailingOnceTransport(LLMTransport):
+    """A transport whose API rejects the first attempt of every call with status_code."""
+
+    def __init__(self, circuit_breaker, status_code):
+        super().__init__(api_key="test", circuit_breaker=circuit_breaker)
+        self.status_code = status_code
+        self.attempts = {}
+
+    def _async_client(self):
+        async def create(messages, **kwargs):
+            key = messages[0]["content"]
+            self.attempts[key] = self.attempts.get(key, 0) + 1
+            await asyncio.sleep(0)
+            if self.attempts[key] == 1:
+                raise StatusError(self.status_code)
+            return SimpleNamespace(usage=None, content=key)
+
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def run_concurrently(transport, calls):
+    async def run():
+        return await asyncio.gather(
+            *(transport.chat(messages=[{"role": "user", "content": str(i)}], model="m", timeout=5) for i in range(calls)),
+            return_exceptions=True
+        )
+
+    return asyncio.run(run())
+
+
+def test_rate_limited_burst_does_not_open_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=5, reset_seconds=60.0)
+    transport = FailingOnceTransport(breaker, 429)
+    results = run_concurrently(transport, 8)
+    assert [getattr(result, "content", result) for result in results] == [str(i) for i in range(8)]
+    assert breaker.state == "closed"
+
+
+def test_retries_of_admitted_calls_continue_after_the_breaker_opens():
+    # Eight concurrent 503s open the breaker, but calls it already let through keep their retries.
+    breaker = CircuitBreaker(failure_threshold=5, reset_seconds=60.0)
+    transport = FailingOnceTransport(breaker, 503)
+    results = run_concurrently(transport, 8)
+    assert not any(isinstance(result, Exception) for result in results)
+    assert breaker.state == "closed"  # The successful retries closed it again
+    # New calls are still refused while it is open.
+    for _ in range(5):
+        breaker.record_failure()
+    assert isinstance(run_concurrently(transport, 1)[0], CircuitOpenError)
+
+
+def open_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.0)
+    breaker.record_failure()
+    assert breaker.state == "half_open"
+    return breaker
+
+
+def test_cancelled_trial_call_releases_the_half_open_slot():
+    breaker = open_breaker()
+    transport = HangingTransport(breaker)
+
+    async def run():
+        # Two prompts fired together in half-open state: one takes the trial, the other is rejected
+        # and its caller cancels the trial, as run_ledger_prompts does.
+        trial = asyncio.ensure_future(transport.chat(messages=[{"role": "user", "content": "a"}], model="m", timeout=5))
+        rejected = asyncio.ensure_future(transport.chat(messages=[{"role": "user", "content": "b"}], model="m", timeout=5))
+        with pytest.raises(CircuitOpenError):
+            await rejected
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+    asyncio.run(run())
+    assert transport.started == 1
+    assert breaker.state == "half_open"
+    # The next call may take the trial again instead of failing fast forever.
+    assert breaker.before_call() is True
+
+
+def test_cancelled_call_in_closed_state_leaves_a_later_trial_alone():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.0)
+    transport = HangingTransport(breaker)
+
+    async def run():
+        call = asyncio.ensure_future(transport.chat(messages=[{"role": "user", "content": "a"}], model="m", timeout=5))
+        await asyncio.sleep(0)
+        breaker.record_failure()
+        assert breaker.before_call() is True  # Another caller holds the trial now
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+
+    asyncio.run(run())
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+class PublicChatBackend(LLMBackend):
+    """Wraps another backend by overriding the public methods, like the benchmarks' MeasuredBackend."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = 0
+
+    async def chat(self, messages, model, timeout=None, **kwargs):
+        self.calls += 1
+        return await self.backend.chat(messages, model, timeout, **kwargs)
+
+    def chat_sync(self, messages, model, timeout=None, **kwargs):
+        self.calls += 1
+        return self.backend.chat_sync(messages, model, timeout, **kwargs)
+
+
+def test_rate_limited_backend_wraps_backends_that_override_chat():
+    limiter = RateLimiter(requests_per_minute=100)
+    inner = PublicChatBackend(ScriptedBackend(["hi"]))
+    backend = RateLimitedBackend(inner, limiter)
+    messages = [{"role": "user", "content": "hello"}]
+    assert asyncio.run(backend.chat(messages, "m")).choices[0].message.content == "hi"
+    assert backend.chat_sync(messages, "m").choices[0].message.content == "hi"
+    assert inner.calls == 2
+    assert len(limiter._reservations) == 2
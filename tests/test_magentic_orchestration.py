@@ -0,0 +1,41 @@
+import os
+import sys
+import json
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("httpx")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "magentic"))
+from magentic_orchestration import LedgerParseError, parse_progress_ledger
+
+PARTICIPANTS = ["researcher", "coder"]
+
+LEDGER = {
+    "is_request_satisfied": {"reason": "Nothing has been written yet.", "answer": False},
+    "is_in_loop": {"reason": "First step.", "answer": False},
+    "is_progress_being_made": {"reason": "Just started.", "answer": True},
+    "next_speaker": {"reason": "Needs sources first.", "answer": "researcher"},
+    "instruction_or_question": {"reason": "Start with background.", "answer": "Find three sources."}
+}
+
+
+def test_parses_a_fenced_ledger():
+    ledger = parse_progress_ledger(f"Here is the ledger:\n```json\n{json.dumps(LEDGER, indent=2)}\n```", PARTICIPANTS)
+    assert ledger.next_speaker == "researcher"
+    assert ledger.instruction_or_question == "Find three sources."
+    assert ledger.is_progress_being_made is True
+    assert ledger.is_request_satisfied is False
+
+
+def test_ignores_text_after_the_ledger():
+    ledger = parse_progress_ledger(json.dumps(LEDGER) + "\nLet me know if {anything} should change.", PARTICIPANTS)
+    assert ledger.next_speaker == "researcher"
+    assert ledger.parallel_steps == []
+
+
+def test_rejects_a_speaker_outside_the_team():
+    data = dict(LEDGER, next_speaker={"reason": "", "answer": "reviewer"})
+    with pytest.raises(LedgerParseError, match="reviewer"):
+        parse_progress_ledger(json.dumps(data), PARTICIPANTS)
@@ -0,0 +1,236 @@
+"""Tracing spans for the agent loops: LLM calls, tool runs, summarization and ledger parsing.
+
+The default tracer is a no-op that hands out one shared span object, so instrumented code costs
+a function call per span when tracing is off. To record spans, install a RecordingTracer with a
+sink, either in code or through the environment:
+
+    set_tracer(RecordingTracer(JsonlSink("traces.jsonl")))
+    AGENT_TRACE_FILE=traces.jsonl AGENT_TRACE_FORMAT=otlp python customer_service_agent.py
+
+Spans nest through contextvars, so they follow asyncio tasks and asyncio.to_thread calls.
+Work submitted to plain executors starts a new trace.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_current_tracer = contextvars.ContextVar("current_tracer", default=None)
+
+
+class NoopSpan:
+    __slots__ = ()
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def record_error(self, error):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Span:
+    """A timed operation with attributes; exported to the tracer's sink when it ends."""
+
+    def __init__(self, tracer, name, attributes, parent=None):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent else None
+        self.start_ns = None
+        self.end_ns = None
+        self.error = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes):
+        self.attributes.update(attributes)
+
+    def record_error(self, error):
+        self.error = f"{type(error).__name__}: {error}"
+
+    @property
+    def duration_ms(self):
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        if exc is not None:
+            self.record_error(exc)
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # An async generator closed from another context; its span has already been detached.
+            pass
+        self.tracer.export(self)
+        return False
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class Tracer:
+    """The no-op tracer."""
+
+    def span(self, name, **attributes):
+        return NOOP_SPAN
+
+    def export(self, span):
+        pass
+
+
+class RecordingTracer(Tracer):
+    def __init__(self, sink):
+        self.sink = sink
+
+    def span(self, name, **attributes):
+        parent = _current_span.get()
+        return Span(self, name, attributes, parent)
+
+    def export(self, span):
+        self.sink.export(span)
+
+
+class InMemorySink:
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+
+class JsonlSink:
+    """Appends one JSON object per finished span."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _write(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def export(self, span):
+        self._write(span.to_dict())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": value if isinstance(value, str) else json.dumps(value, default=str)}
+
+
+class OTLPJsonSink(JsonlSink):
+    """Writes each span as an OTLP/JSON ExportTraceServiceRequest line, as read by the
+    OpenTelemetry collector's otlpjsonfile receiver."""
+
+    def __init__(self, path, service_name="agents"):
+        super().__init__(path)
+        self.service_name = service_name
+
+    def export(self, span):
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        self._write({
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": "agents.tracing"}, "spans": [otlp_span]}],
+            }]
+        })
+
+
+def tracer_from_env():
+    path = os.getenv("AGENT_TRACE_FILE")
+    if not path:
+        return Tracer()
+    if os.getenv("AGENT_TRACE_FORMAT", "jsonl").lower() == "otlp":
+        return RecordingTracer(OTLPJsonSink(path, os.getenv("AGENT_TRACE_SERVICE", "agents")))
+    return RecordingTracer(JsonlSink(path))
+
+
+_default_tracer = tracer_from_env()
+
+
+def set_tracer(tracer):
+    """Installs the process-wide tracer used when no use_tracer() block is active."""
+    global _default_tracer
+    _default_tracer = tracer or Tracer()
+
+
+def get_tracer():
+    return _current_tracer.get() or _default_tracer
+
+
+@contextlib.contextmanager
+def use_tracer(tracer):
+    """Routes spans started in this context (and the tasks it spawns) to tracer."""
+    token = _current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _current_tracer.reset(token)
+
+
+def span(name, **attributes):
+    return get_tracer().span(name, **attributes)
+
+
+def current_span():
+    return _current_span.get() or NOOP_SPAN